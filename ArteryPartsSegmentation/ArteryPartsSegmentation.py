@@ -3,6 +3,9 @@ import os
 from typing import Annotated, Optional
 
 import vtk
+from vtk.util import numpy_support
+import numpy as np
+from scipy import ndimage
 
 import slicer
 from slicer.ScriptedLoadableModule import *
@@ -107,10 +110,13 @@ class ArteryPartsSegmentationWidget(ScriptedLoadableModuleWidget, VTKObservation
 
         # Buttons
         self.ui.applyButton.connect('clicked(bool)', self.onApplyButton)
+        self.ui.profileButton.connect('clicked(bool)', self.onProfileButton)
+        self.ui.calciumScoreButton.connect('clicked(bool)', self.onCalciumScoreButton)
         # rangeChanged(double, double) fails.
         self.ui.lumenIntensityRangeWidget.connect('minimumValueChanged(double)', lambda value: self.onIntensityRangeChanged(value, self.ui.lumenIntensityRangeWidget.maximumValue))
         self.ui.lumenIntensityRangeWidget.connect('maximumValueChanged(double)', lambda value: self.onIntensityRangeChanged(self.ui.lumenIntensityRangeWidget.minimumValue, value))
         self.ui.previewToolButton.connect('clicked(bool)', self.onPreview)
+        self.ui.estimateToolButton.connect('clicked(bool)', self.onEstimateLumenIntensityRange)
         self.ui.softCalcificationCheckBox.connect('clicked(bool)', self.onAccountForSoftCalcification)
         self.ui.extrusionGroupBox.connect('clicked(bool)', self.onExtrusionKernelSize)
 
@@ -118,10 +124,9 @@ class ArteryPartsSegmentationWidget(ScriptedLoadableModuleWidget, VTKObservation
         self.initializeParameterNode()
         
         # Keep track of these as they are used in many places.
-        self.TubeSegmentID = ""
-        self.LumenSegmentID = ""
-        self.SegmentEditorWidget = None
-        self.SplitVolumeNode = None
+        self.PreviewLabelMapNode = None
+        self.IntensityIndex = None
+        self.PreviewRange = (0, 0)
 
         if not slicer.app.testingEnabled():
             try:
@@ -187,6 +192,7 @@ class ArteryPartsSegmentationWidget(ScriptedLoadableModuleWidget, VTKObservation
         """
         # Parameter node will be reset, do not use it anymore
         self.setParameterNode(None)
+        self.logic.clearTubeBoxCache()
 
     def onSceneEndClose(self, caller, event) -> None:
         """
@@ -239,15 +245,49 @@ class ArteryPartsSegmentationWidget(ScriptedLoadableModuleWidget, VTKObservation
             extrusionKernelSize = 0.0
             if self.ui.extrusionGroupBox.isChecked():
                 extrusionKernelSize = self.ui.extrusionKernelSizeSpinBox.value
+            useSegmentEditor = self.ui.useSegmentEditorCheckBox.isChecked()
+            straighten = self.ui.straightenCheckBox.isChecked()
             
             self.logic.process(shapeNode, volumeNode, segmentationNode,
                                lumenIntensityMin, lumenIntensityMax,
-                               accountForSoftCalcification, extrusionKernelSize)
+                               accountForSoftCalcification, extrusionKernelSize,
+                               useSegmentEditor, straighten)
+
+    def onEstimateLumenIntensityRange(self) -> None:
+        with slicer.util.tryWithErrorDisplay("Failed to estimate the lumen intensity range.", waitCursor=True):
+            if not self.checkNodes():
+                return
+            shapeNode = self.ui.inputShapeSelector.currentNode()
+            volumeNode = self.ui.inputVolumeSelector.currentNode()
+            lumenIntensityMin, lumenIntensityMax = self.logic.estimateLumenIntensityRange(shapeNode, volumeNode)
+            # The preview follows the range widget.
+            self.ui.lumenIntensityRangeWidget.setValues(lumenIntensityMin, lumenIntensityMax)
+
+    def onProfileButton(self) -> None:
+        with slicer.util.tryWithErrorDisplay("Failed to compute the cross-section profile.", waitCursor=True):
+            if not self.checkNodes():
+                return
+            shapeNode = self.ui.inputShapeSelector.currentNode()
+            volumeNode = self.ui.inputVolumeSelector.currentNode()
+            segmentationNode = self.ui.outputSegmentationSelector.currentNode()
+            self.logic.createCrossSectionProfile(shapeNode, volumeNode, segmentationNode)
+
+    def onCalciumScoreButton(self) -> None:
+        with slicer.util.tryWithErrorDisplay("Failed to compute the calcium score.", waitCursor=True):
+            volumeNode = self.ui.inputVolumeSelector.currentNode()
+            segmentationNode = self.ui.outputSegmentationSelector.currentNode()
+            if not volumeNode or not segmentationNode:
+                self.showStatusMessage("Select a volume and a segmentation.")
+                return
+            tableNode = self.logic.createCalciumScoreTable(volumeNode, segmentationNode)
+            slicer.app.applicationLogic().GetSelectionNode().SetActiveTableID(tableNode.GetID())
+            slicer.app.applicationLogic().PropagateTableSelection()
     
     """
-    Use the 'Threshold' effect to preview the lumen. The intensity range can be
-    adjusted using the slider. Mouse dragging in slice views is not taken into
-    account. The effect itself is never applied.
+    Preview the lumen in a label map of the bounding box of the tube. The
+    intensities of the voxels inside the tube are indexed once; moving the
+    slider then only updates the voxels whose intensities are crossed by the
+    moved bound. The number of voxels and the volume of the lumen are shown.
     """
     def onPreview(self) -> None:
         button = self.ui.previewToolButton
@@ -260,89 +300,37 @@ class ArteryPartsSegmentationWidget(ScriptedLoadableModuleWidget, VTKObservation
         
         shapeNode = self.ui.inputShapeSelector.currentNode()
         volumeNode = self.ui.inputVolumeSelector.currentNode()
-        segmentationNode = self.ui.outputSegmentationSelector.currentNode()
-        
-        # Create slicer.modules.SegmentEditorWidget
-        slicer.modules.segmenteditor.widgetRepresentation()
-        self.SegmentEditorWidget = slicer.modules.SegmentEditorWidget.editor
-        seWidget = self.SegmentEditorWidget
-        seWidget.setSegmentationNode(segmentationNode)
-        seWidget.setSourceVolumeNode(volumeNode)
-        segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(volumeNode)
         
-        # Crop the volume to the inside of the Tube using 'Split volume'.
-        tubePolyData = shapeNode.GetCappedTubeWorld()
-        segmentationNode.CreateClosedSurfaceRepresentation()
-        self.TubeSegmentID = segmentationNode.AddSegmentFromClosedSurfaceRepresentation(tubePolyData, "Tube")
-        seWidget.mrmlSegmentEditorNode().SetSelectedSegmentID(self.TubeSegmentID)
-        
-        intensityRange = volumeNode.GetImageData().GetScalarRange()
-        seWidget.setActiveEffectByName("Split volume")
-        effect = seWidget.activeEffect()
-        # Fill with an intensity that does not exist in the volume, to avoid space outside the Tube later.
-        effect.setParameter("FillValue", intensityRange[0] - 1)
-        effect.setParameter("ApplyToAllVisibleSegments", 0)
-        effect.self().onApply()
-        seWidget.setActiveEffectByName(None)
-        
-        # Get the split volume. 'Split volume' effect does not provide it.
-        allScalarVolumeNodes = slicer.mrmlScene.GetNodesByClass("vtkMRMLScalarVolumeNode")
-        self.SplitVolumeNode = allScalarVolumeNodes.GetItemAsObject(allScalarVolumeNodes.GetNumberOfItems() - 1)
-        splitVolumeNode = self.SplitVolumeNode
-        seWidget.setSourceVolumeNode(splitVolumeNode)
-        segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(splitVolumeNode)
-        
-        # The tube segment passed to 'Split volume' is no longer needed.
-        if segmentationNode.GetSegmentation().GetSegment(self.TubeSegmentID):
-            segmentationNode.GetSegmentation().RemoveSegment(self.TubeSegmentID)
-        self.TubeSegmentID = ""
-        
-        # Create a segment to preview the lumen in slice views using 'Threshold' effect.
-        self.LumenSegmentID = segmentationNode.GetSegmentation().AddEmptySegment("LumenPreview")
-        seWidget.mrmlSegmentEditorNode().SetSelectedSegmentID(self.LumenSegmentID)
-        seWidget.setActiveEffectByName("Threshold")
-        effect = seWidget.activeEffect()
-        effect.setParameter("MinimumThreshold", str(self.ui.lumenIntensityRangeWidget.minimumValue))
-        effect.setParameter("MaximumThreshold", str(self.ui.lumenIntensityRangeWidget.maximumValue))
-        # Don't apply, just a preview to get intensity range.
-        
-        # Reparent subject hierarchy items.
-        shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-        shSplitVolumeId = shNode.GetItemByDataNode(splitVolumeNode)
-        shSplitVolumeFolderId = shNode.GetItemParent(shSplitVolumeId) # To be removed.
-        shSplitVolumeStudyId = shNode.GetItemParent(shSplitVolumeFolderId) # Is root scene ID for NRRD files.
-        shSegmentationId = shNode.GetItemByDataNode(segmentationNode)
-        shNode.SetItemParent(shSplitVolumeId, shSplitVolumeStudyId)
-        shNode.SetItemParent(shSegmentationId, shSplitVolumeStudyId)
-        if shNode.GetItemLevel(shSplitVolumeFolderId) == "Folder":
-            shNode.RemoveItem(shSplitVolumeFolderId)
+        try:
+            self.PreviewLabelMapNode, self.IntensityIndex = self.logic.createPreviewLabelMap(shapeNode, volumeNode)
+        except ValueError as e:
+            self.showStatusMessage(str(e))
+            button.setChecked(False)
+            return
+        self.PreviewRange = (0, 0)
+        slicer.util.setSliceViewerLayers(label = self.PreviewLabelMapNode)
+        self.onIntensityRangeChanged(self.ui.lumenIntensityRangeWidget.minimumValue,
+                                     self.ui.lumenIntensityRangeWidget.maximumValue)
     
     # Remove all temporary objects.
     def exitPreview(self) -> None:
-        segmentationNode = self.ui.outputSegmentationSelector.currentNode()
-        # Terminate any active effect.
-        if self.SegmentEditorWidget:
-            self.SegmentEditorWidget.setActiveEffectByName(None)
-            self.SegmentEditorWidget = None
-        if segmentationNode and segmentationNode.GetSegmentation().GetSegment(self.TubeSegmentID):
-            segmentationNode.GetSegmentation().RemoveSegment(self.TubeSegmentID)
-            self.TubeSegmentID = ""
-        if segmentationNode and segmentationNode.GetSegmentation().GetSegment(self.LumenSegmentID):
-            segmentationNode.GetSegmentation().RemoveSegment(self.LumenSegmentID)
-            self.LumenSegmentID = ""
-        if self.SplitVolumeNode:
-            slicer.mrmlScene.RemoveNode(self.SplitVolumeNode)
-            self.SplitVolumeNode = None
+        if self.PreviewLabelMapNode:
+            slicer.mrmlScene.RemoveNode(self.PreviewLabelMapNode)
+            self.PreviewLabelMapNode = None
+        self.IntensityIndex = None
+        self.PreviewRange = (0, 0)
+        self.ui.previewLabel.text = ""
     
-    # Tune the active 'Threshold' effect, used for preview only.
+    # Update the preview label map, and the size of the lumen.
     def onIntensityRangeChanged(self, min, max) -> None:
-        if not self.SegmentEditorWidget:
+        if not self.PreviewLabelMapNode:
             return
-        seWidget = self.SegmentEditorWidget
-        seWidget.setActiveEffectByName("Threshold")
-        effect = seWidget.activeEffect()
-        effect.setParameter("MinimumThreshold", str(min))
-        effect.setParameter("MaximumThreshold", str(max))
+        self.PreviewRange = self.logic.updatePreviewLabelMap(self.PreviewLabelMapNode, self.IntensityIndex,
+                                                             self.PreviewRange, min, max)
+        numberOfVoxels = self.PreviewRange[1] - self.PreviewRange[0]
+        spacing = self.PreviewLabelMapNode.GetSpacing()
+        volumeMm3 = numberOfVoxels * spacing[0] * spacing[1] * spacing[2]
+        self.ui.previewLabel.text = f"Lumen: {numberOfVoxels} voxels, {volumeMm3 / 1000.0:.2f} mL"
     
     def onAccountForSoftCalcification(self, value) -> None:
         if value:
@@ -396,11 +384,19 @@ class ArteryPartsSegmentationLogic(ScriptedLoadableModuleLogic):
     https://github.com/Slicer/Slicer/blob/main/Base/Python/slicer/ScriptedLoadableModule.py
     """
 
+    # Segment names, in the order of their label values, starting from 1.
+    partNames = ("Lumen", "Calcification", "Soft lesion")
+    # Bytes of the tube boxes kept by _tubeBox(), with the values derived from them.
+    tubeBoxCacheBytes = 256 * 1024**2
+    # Tag of the segments of processTubes(), with the ID of their shape node.
+    tagSourceShapeId = "SourceShapeId"
+
     def __init__(self) -> None:
         """
         Called when the logic class is instantiated. Can be used for initializing member variables.
         """
         ScriptedLoadableModuleLogic.__init__(self)
+        self._tubeBoxCache = {}
 
     def getParameterNode(self):
         return ArteryPartsSegmentationParameterNode(super().getParameterNode())
@@ -412,10 +408,178 @@ class ArteryPartsSegmentationLogic(ScriptedLoadableModuleLogic):
                 lumenIntensityMin: float = 200.0,
                 lumenIntensityMax: float = 450.0,
                 accountForSoftCalcification = False,
-                extrusionKernelSize = 0.0) -> None:
+                extrusionKernelSize = 0.0,
+                useSegmentEditor = False,
+                straighten = False) -> None:
+        """
+        Segment the artery inside the tube in lumen, calcification and soft lesion.
+        With useSegmentEditor, 'Threshold', 'Smoothing' and 'Islands' effects
+        are used on a masked copy of the bounding box of the tube.
+        Otherwise, the tube is rasterized once, and the voxels inside are
+        classified on the voxel array, without any Segment editor effect.
+        With straighten, they are classified in a volume resampled along the
+        centerline of the tube, see straightenTube(); not with useSegmentEditor.
+        A lumen intensity bound of None is estimated, see estimateLumenIntensityRange().
+        """
 
         if not shapeNode or not volumeNode or not segmentationNode:
             raise ValueError("Invalid input or output nodes.")
+        self._checkShapeNode(shapeNode)
+
+        import time
+        startTime = time.time()
+        logging.info('Processing started')
+
+        lumenIntensityMin, lumenIntensityMax = self._completeLumenIntensityRange(shapeNode, volumeNode,
+                                                                                 lumenIntensityMin, lumenIntensityMax)
+        if useSegmentEditor:
+            self._processWithSegmentEditor(shapeNode, volumeNode, segmentationNode,
+                                           lumenIntensityMin, lumenIntensityMax,
+                                           accountForSoftCalcification, extrusionKernelSize)
+        else:
+            self._processWithArrays(shapeNode, volumeNode, segmentationNode,
+                                    lumenIntensityMin, lumenIntensityMax,
+                                    accountForSoftCalcification, extrusionKernelSize,
+                                    straighten)
+
+        stopTime = time.time()
+        logging.info(f'Processing completed in {stopTime-startTime:.2f} seconds')
+
+    def processTubes(self,
+                     shapeNodes,
+                     volumeNode: slicer.vtkMRMLScalarVolumeNode,
+                     segmentationNode: slicer.vtkMRMLSegmentationNode,
+                     parameterSets = None,
+                     numberOfWorkers = None) -> None:
+        """
+        Segment the arteries of several tubes in one call, as process() on
+        the voxel array. parameterSets is a list of dictionaries of keyword
+        arguments of process(), one per tube, or a single dictionary for all
+        tubes; useSegmentEditor is not supported.
+        The segments of a tube are named after the shape node, tagged with its
+        ID, and share a layer. Tubes whose bounding boxes do not overlap are
+        classified concurrently on a thread pool; a tube that overlaps a
+        previous one waits for its segments, that are not calcification.
+        """
+
+        if not shapeNodes or not volumeNode or not segmentationNode:
+            raise ValueError("Invalid input or output nodes.")
+        for shapeNode in shapeNodes:
+            self._checkShapeNode(shapeNode)
+        if parameterSets is None:
+            parameterSets = {}
+        if isinstance(parameterSets, dict):
+            parameterSets = [parameterSets] * len(shapeNodes)
+        if len(parameterSets) != len(shapeNodes):
+            raise ValueError("The number of parameter sets does not match the number of shape nodes.")
+        parameterNames = ("lumenIntensityMin", "lumenIntensityMax", "accountForSoftCalcification",
+                          "extrusionKernelSize", "straighten")
+        for parameterSet in parameterSets:
+            unknownNames = set(parameterSet) - set(parameterNames)
+            if unknownNames:
+                raise ValueError(f"Unknown parameters: {', '.join(sorted(unknownNames))}.")
+
+        import time
+        startTime = time.time()
+        logging.info('Processing started')
+
+        from concurrent.futures import ThreadPoolExecutor
+        segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(volumeNode)
+        segmentation = segmentationNode.GetSegmentation()
+        for shapeNode in shapeNodes:
+            self._removeSourceShapeSegments(segmentationNode, shapeNode)
+        # Only the MRML and VTK work is done on the main thread: the tube boxes and the segments.
+        # The boxes are kept for the call, the cache may not hold them all.
+        tubeBoxes = [self._tubeBox(shapeNode, volumeNode) for shapeNode in shapeNodes]
+        tubeExtents = [tubeBox["extent"] for tubeBox in tubeBoxes]
+        with ThreadPoolExecutor(max_workers = numberOfWorkers) as executor:
+            for wave in self._disjointWaves(tubeExtents):
+                tubeTasks = []
+                for tubeIndex in wave:
+                    parameterSet = dict(parameterSets[tubeIndex])
+                    parameterSet["lumenIntensityMin"], parameterSet["lumenIntensityMax"] = self._completeLumenIntensityRange(
+                        shapeNodes[tubeIndex], volumeNode,
+                        parameterSet.get("lumenIntensityMin", 200.0), parameterSet.get("lumenIntensityMax", 450.0))
+                    tubeTask = self._prepareTube(shapeNodes[tubeIndex], volumeNode, segmentationNode,
+                                                 parameterSet.pop("straighten", False), tubeBoxes[tubeIndex])
+                    tubeTasks.append((tubeIndex, tubeTask, executor.submit(self._classifyTube, tubeTask, **parameterSet)))
+                for tubeIndex, tubeTask, future in tubeTasks:
+                    shapeNode = shapeNodes[tubeIndex]
+                    segmentNames = [f"{shapeNode.GetName()} {partName}" for partName in self.partNames]
+                    segmentIDs = self._addPartSegments(segmentationNode, tubeTask["image"], future.result(), segmentNames)
+                    for segmentID in segmentIDs:
+                        segmentation.GetSegment(segmentID).SetTag(self.tagSourceShapeId, vtk.reference(shapeNode.GetID()))
+
+        stopTime = time.time()
+        logging.info(f'Processing completed in {stopTime-startTime:.2f} seconds')
+
+    def estimateLumenIntensityRange(self, shapeNode, volumeNode, coreRadiusFraction = 0.5,
+                                    numberOfStandardDeviations = 2.5):
+        """
+        Propose a lumen intensity range from the voxels near the axis of the
+        tube, within coreRadiusFraction of its radius, sampled in the
+        cross-sections of straightenTube(), without interpolation that would
+        narrow the distribution. The contrast enhanced lumen is
+        the highest peak of their histogram; a gaussian is fitted to it by
+        its full width at half maximum. Return its mean minus and plus
+        numberOfStandardDeviations.
+        """
+        tubeBox = self._tubeBox(shapeNode, volumeNode)
+        straightenedTube = self.straightenTube(shapeNode, volumeNode)
+        radii = straightenedTube["centerline"][4]
+        step = straightenedTube["spacing"][2]
+        halfSize = (straightenedTube["mask"].shape[1] - 1) // 2
+        offsets = (np.arange(-halfSize, halfSize + 1) * step) ** 2
+        squaredRadialDistances = offsets[:, np.newaxis] + offsets[np.newaxis, :]
+        coreMask = squaredRadialDistances[np.newaxis] <= ((coreRadiusFraction * radii) ** 2)[:, np.newaxis, np.newaxis]
+        coreMask &= straightenedTube["mask"]
+        coreCoordinates = self._crossSectionCoordinates(straightenedTube["centerline"], step, halfSize,
+                                                        volumeNode, tubeBox["extent"])[:, coreMask]
+        coreValues = ndimage.map_coordinates(tubeBox["array"], coreCoordinates, order = 0, mode = "nearest")
+        if coreValues.size == 0:
+            raise ValueError("The tube is too thin to estimate the lumen intensity range.")
+
+        # Calcification and noise outliers are out of the histogram.
+        lowestValue, highestValue = np.percentile(coreValues, (0.5, 99.5))
+        if highestValue <= lowestValue:
+            return float(lowestValue), float(highestValue)
+        # Freedman-Diaconis bins, not finer than the intensity steps.
+        binEdges = np.histogram_bin_edges(coreValues, bins = "fd", range = (lowestValue, highestValue))
+        numberOfBins = len(binEdges) - 1
+        if np.issubdtype(coreValues.dtype, np.integer):
+            numberOfBins = int(min(numberOfBins, highestValue - lowestValue + 1))
+        histogram, binEdges = np.histogram(coreValues, bins = numberOfBins, range = (lowestValue, highestValue))
+        histogram = ndimage.gaussian_filter1d(histogram.astype(np.float64), 1.0)
+        binWidth = binEdges[1] - binEdges[0]
+        peakIndex = int(histogram.argmax())
+        halfMaximum = histogram[peakIndex] / 2.0
+        # Half maximum crossings, interpolated between the bins, or the histogram ends.
+        below = np.flatnonzero(histogram[:peakIndex] < halfMaximum)
+        leftIndex = 0.0
+        if below.size:
+            leftIndex = below[-1] + (halfMaximum - histogram[below[-1]]) / (histogram[below[-1] + 1] - histogram[below[-1]])
+        below = np.flatnonzero(histogram[peakIndex + 1:] < halfMaximum)
+        rightIndex = float(len(histogram) - 1)
+        if below.size:
+            rightIndex = peakIndex + below[0] + 1
+            rightIndex -= (halfMaximum - histogram[rightIndex]) / (histogram[rightIndex - 1] - histogram[rightIndex])
+        standardDeviation = max(rightIndex - leftIndex, 1.0) * binWidth / (2.0 * np.sqrt(2.0 * np.log(2.0)))
+        mean = binEdges[0] + (peakIndex + 0.5) * binWidth
+        return (float(mean - numberOfStandardDeviations * standardDeviation),
+                float(mean + numberOfStandardDeviations * standardDeviation))
+
+    def _completeLumenIntensityRange(self, shapeNode, volumeNode, lumenIntensityMin, lumenIntensityMax):
+        # Bounds that are None are estimated.
+        if lumenIntensityMin is not None and lumenIntensityMax is not None:
+            return lumenIntensityMin, lumenIntensityMax
+        estimatedRange = self.estimateLumenIntensityRange(shapeNode, volumeNode)
+        logging.info(f"Estimated lumen intensity range: {estimatedRange[0]:.1f} - {estimatedRange[1]:.1f}")
+        return (estimatedRange[0] if lumenIntensityMin is None else lumenIntensityMin,
+                estimatedRange[1] if lumenIntensityMax is None else lumenIntensityMax)
+
+    def _checkShapeNode(self, shapeNode):
+        if not shapeNode:
+            raise ValueError("Invalid input or output nodes.")
         if shapeNode.GetShapeName() != slicer.vtkMRMLMarkupsShapeNode.Tube:
             raise ValueError("Shape node is not a Tube.")
         if shapeNode.GetNumberOfUndefinedControlPoints():
@@ -423,10 +587,59 @@ class ArteryPartsSegmentationLogic(ScriptedLoadableModuleLogic):
         if shapeNode.GetNumberOfControlPoints() < 4:
             raise ValueError("Shape node has less than 4 control points.")
 
-        import time
-        startTime = time.time()
-        logging.info('Processing started')
+    def _disjointWaves(self, extents):
+        """
+        Group the indices of extents in successive waves, without overlapping
+        extents in a wave. An extent is put in the wave following the last one
+        it overlaps, to keep the order of the overlapping extents.
+        """
+        waves = []
+        for index, extent in enumerate(extents):
+            waveIndex = 0
+            for previousWaveIndex, wave in enumerate(waves):
+                if any(self._extentsOverlap(extent, extents[previousIndex]) for previousIndex in wave):
+                    waveIndex = previousWaveIndex + 1
+            if waveIndex == len(waves):
+                waves.append([])
+            waves[waveIndex].append(index)
+        return waves
+
+    def _extentsOverlap(self, extent, otherExtent):
+        return all(extent[2 * axis] <= otherExtent[2 * axis + 1] and otherExtent[2 * axis] <= extent[2 * axis + 1]
+                   for axis in range(3))
+
+    def _removeSourceShapeSegments(self, segmentationNode, shapeNode):
+        # Segments of a previous run of processTubes() on shapeNode.
+        segmentation = segmentationNode.GetSegmentation()
+        for segmentID in segmentation.GetSegmentIDs():
+            reference = vtk.reference("")
+            segmentation.GetSegment(segmentID).GetTag(self.tagSourceShapeId, reference)
+            if reference.get() == shapeNode.GetID():
+                segmentation.RemoveSegment(segmentID)
+
+    def _partSegmentIDs(self, segmentationNode, shapeNode):
+        """
+        The segment ID of each of partNames for shapeNode, or None.
+        The segments of processTubes() are tagged with the ID of their shape
+        node, and named after it. A segmentation of a single shape, as made by
+        process(), has segments named after the parts only.
+        """
+        segmentation = segmentationNode.GetSegmentation()
+        shapeSegmentIDs = []
+        for segmentID in segmentation.GetSegmentIDs():
+            reference = vtk.reference("")
+            segmentation.GetSegment(segmentID).GetTag(self.tagSourceShapeId, reference)
+            if reference.get() == shapeNode.GetID():
+                shapeSegmentIDs.append(segmentID)
+        if not shapeSegmentIDs:
+            return [segmentation.GetSegmentIdBySegmentName(partName) or None for partName in self.partNames]
+        return [next((segmentID for segmentID in shapeSegmentIDs
+                      if segmentation.GetSegment(segmentID).GetName().endswith(partName)), None)
+                for partName in self.partNames]
 
+    def _processWithSegmentEditor(self, shapeNode, volumeNode, segmentationNode,
+                                  lumenIntensityMin, lumenIntensityMax,
+                                  accountForSoftCalcification, extrusionKernelSize):
         # Create slicer.modules.SegmentEditorWidget
         slicer.modules.segmenteditor.widgetRepresentation()
         seWidget = slicer.modules.SegmentEditorWidget.editor
@@ -439,28 +652,11 @@ class ArteryPartsSegmentationLogic(ScriptedLoadableModuleLogic):
         seWidget.mrmlSegmentEditorNode().SourceVolumeIntensityMaskOff()
         seWidget.mrmlSegmentEditorNode().SetOverwriteMode(seWidget.mrmlSegmentEditorNode().OverwriteNone)
         
-        # Crop the volume to the inside of the Tube using 'Split volume'.
-        tubePolyData = shapeNode.GetCappedTubeWorld()
-        segmentationNode.CreateClosedSurfaceRepresentation()
-        tubeSegmentID = segmentationNode.AddSegmentFromClosedSurfaceRepresentation(tubePolyData, "Tube")
-        seWidget.mrmlSegmentEditorNode().SetSelectedSegmentID(tubeSegmentID)
-        
+        # Crop the volume to the bounding box of the Tube, masked outside the Tube.
         intensityRange = volumeNode.GetImageData().GetScalarRange()
-        seWidget.setActiveEffectByName("Split volume")
-        effect = seWidget.activeEffect()
-        # Fill with an intensity that does not exist in the volume, to avoid space outside the Tube later.
-        effect.setParameter("FillValue", intensityRange[0] - 1)
-        effect.setParameter("ApplyToAllVisibleSegments", 0)
-        effect.self().onApply()
-        seWidget.setActiveEffectByName(None)
-        
-        # Get the split volume. 'Split volume' effect does not provide it.
-        allScalarVolumeNodes = slicer.mrmlScene.GetNodesByClass("vtkMRMLScalarVolumeNode")
-        splitVolumeNode = allScalarVolumeNodes.GetItemAsObject(allScalarVolumeNodes.GetNumberOfItems() - 1)
-        # Use the split volume.
-        segmentationNode.GetSegmentation().RemoveSegment(tubeSegmentID)
-        seWidget.setSourceVolumeNode(splitVolumeNode)
-        segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(splitVolumeNode)
+        tubeVolumeNode = self.createTubeVolume(shapeNode, volumeNode, extrusionKernelSize)
+        seWidget.setSourceVolumeNode(tubeVolumeNode)
+        segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(tubeVolumeNode)
         
         # Create Lumen segment first.
         segmentID = "Lumen"
@@ -566,23 +762,707 @@ class ArteryPartsSegmentationLogic(ScriptedLoadableModuleLogic):
         Manual cleaning with the brush may be helpful too.
         """
         
-        # Reparent subject hierarchy items.
-        shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-        shSplitVolumeId = shNode.GetItemByDataNode(splitVolumeNode)
-        shSplitVolumeFolderId = shNode.GetItemParent(shSplitVolumeId) # To be removed.
-        shSplitVolumeStudyId = shNode.GetItemParent(shSplitVolumeFolderId) # Is root scene ID for NRRD files.
-        shSegmentationId = shNode.GetItemByDataNode(segmentationNode)
-        shNode.SetItemParent(shSplitVolumeId, shSplitVolumeStudyId)
-        shNode.SetItemParent(shSegmentationId, shSplitVolumeStudyId)
-        if shNode.GetItemLevel(shSplitVolumeFolderId) == "Folder":
-            shNode.RemoveItem(shSplitVolumeFolderId)
         # Remove temporary volume and get things back.
-        slicer.mrmlScene.RemoveNode(splitVolumeNode)
+        slicer.mrmlScene.RemoveNode(tubeVolumeNode)
         seWidget.setSourceVolumeNode(volumeNode)
         segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(volumeNode)
 
-        stopTime = time.time()
-        logging.info(f'Processing completed in {stopTime-startTime:.2f} seconds')
+    def _processWithArrays(self, shapeNode, volumeNode, segmentationNode,
+                           lumenIntensityMin, lumenIntensityMax,
+                           accountForSoftCalcification, extrusionKernelSize,
+                           straighten = False):
+        """
+        Same steps as _processWithSegmentEditor, on the voxel array. Only the
+        bounding box of the tube is processed. The parts are written in a
+        single labelmap shared by the three segments.
+        """
+        segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(volumeNode)
+        segmentation = segmentationNode.GetSegmentation()
+        for partName in self.partNames:
+            if segmentation.GetSegment(partName):
+                segmentation.RemoveSegment(partName)
+        tubeTask = self._prepareTube(shapeNode, volumeNode, segmentationNode, straighten)
+        partsArray = self._classifyTube(tubeTask, lumenIntensityMin, lumenIntensityMax,
+                                        accountForSoftCalcification, extrusionKernelSize)
+        self._addPartSegments(segmentationNode, tubeTask["image"], partsArray, self.partNames)
+
+    def _prepareTube(self, shapeNode, volumeNode, segmentationNode, straighten = False, tubeBox = None):
+        """
+        Collect on the main thread all that _classifyTube() needs from the
+        scene, so that it does not touch any MRML or VTK object.
+        tubeBox is the box of _tubeBox(), if already at hand.
+        """
+        # Outside the box is outside the tube: the opening treats it as background, no margin is needed.
+        if tubeBox is None:
+            tubeBox = self._tubeBox(shapeNode, volumeNode)
+        ijkToRAS = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        tubeTask = {
+            "extent": tubeBox["extent"],
+            "mask": tubeBox["mask"],
+            "array": tubeBox["array"],
+            "spacing": volumeNode.GetSpacing(),
+            "ijkToRAS": slicer.util.arrayFromVTKMatrix(ijkToRAS),
+            "image": self._orientedImage(volumeNode, tubeBox["extent"]),
+            "straightenedTube": self._straightenTubeBox(shapeNode, volumeNode, tubeBox) if straighten else None,
+        }
+        # The calcification is segmented outside all other segments.
+        tubeTask["otherSegmentsMask"] = self._segmentsMask(segmentationNode, tubeTask["image"])
+        return tubeTask
+
+    def _classifyTube(self, tubeTask, lumenIntensityMin = 200.0, lumenIntensityMax = 450.0,
+                      accountForSoftCalcification = False, extrusionKernelSize = 0.0):
+        # Return the parts array of a tube prepared by _prepareTube(), in its box.
+        otherSegmentsMask = tubeTask["otherSegmentsMask"]
+        straightenedTube = tubeTask["straightenedTube"]
+        if straightenedTube is not None:
+            straightenedParts = self.classifyTubeVoxels(straightenedTube["array"], straightenedTube["mask"], straightenedTube["spacing"],
+                                                        lumenIntensityMin, lumenIntensityMax,
+                                                        accountForSoftCalcification, extrusionKernelSize)
+            partsArray, unmappedMask = self._unstraightenLabels(straightenedParts, straightenedTube, tubeTask["ijkToRAS"],
+                                                                tubeTask["extent"], tubeTask["mask"])
+            if unmappedMask.any():
+                # These voxels, mostly in the caps past the ends of the centerline, would be
+                # holes; they are classified by their intensity alone.
+                unmappedParts = self.classifyTubeVoxels(tubeTask["array"], unmappedMask, tubeTask["spacing"],
+                                                        lumenIntensityMin, lumenIntensityMax)
+                partsArray[unmappedMask] = unmappedParts[unmappedMask]
+            if otherSegmentsMask is not None:
+                partsArray[(partsArray == 2) & otherSegmentsMask] = 0
+            return partsArray
+        return self.classifyTubeVoxels(tubeTask["array"], tubeTask["mask"], tubeTask["spacing"],
+                                       lumenIntensityMin, lumenIntensityMax,
+                                       accountForSoftCalcification, extrusionKernelSize,
+                                       otherSegmentsMask)
+
+    def _addPartSegments(self, segmentationNode, tubeImage, partsArray, segmentNames):
+        # One segment per part, named after segmentNames. Return the segment IDs.
+        # The parts do not overlap: tubeImage, which is overwritten, holds them
+        # all with their label values and is shared by the segments, the other
+        # segments are left in their layers.
+        np.copyto(self._imageArray(tubeImage), partsArray)
+        segmentation = segmentationNode.GetSegmentation()
+        binaryLabelmapName = slicer.vtkSegmentationConverter.GetBinaryLabelmapRepresentationName()
+        segmentIDs = []
+        for labelValue, segmentName in enumerate(segmentNames, 1):
+            segment = slicer.vtkSegment()
+            segment.SetName(segmentName)
+            segment.SetLabelValue(labelValue)
+            segment.AddRepresentation(binaryLabelmapName, tubeImage)
+            segmentation.AddSegment(segment)
+            segmentIDs.append(segmentation.GetSegmentIdBySegment(segment))
+        return segmentIDs
+
+    def classifyTubeVoxels(self, volumeArray, tubeMask, spacing,
+                           lumenIntensityMin = 200.0, lumenIntensityMax = 450.0,
+                           accountForSoftCalcification = False, extrusionKernelSize = 0.0,
+                           maskedOutMask = None):
+        """
+        volumeArray and the masks are in KJI order, spacing in IJK order.
+        Every voxel of tubeMask is classified by its intensity, in a single
+        pass over the voxels of the tube; only the lumen is processed in 3D,
+        with an opening and keeping its largest island, as the Segment editor
+        steps, within its own bounding box.
+        The calcification is not classified in maskedOutMask.
+        Return a uint8 array, with the label values of partNames, 0 elsewhere.
+        """
+        tubeValues = volumeArray[tubeMask]
+        # Leave lumenIntensityMin to the lumen.
+        tubeParts = np.where(tubeValues <= lumenIntensityMin - 1, np.uint8(3), np.uint8(0))
+        isLumen = (tubeValues >= lumenIntensityMin) & (tubeValues <= lumenIntensityMax)
+        if accountForSoftCalcification or (extrusionKernelSize > 0.0):
+            lumenMask = np.zeros(volumeArray.shape, dtype = np.bool_)
+            lumenMask[tubeMask] = isLumen
+            # The opening and the islands stay within the lumen, and outside is background.
+            lumenObjects = ndimage.find_objects(lumenMask.view(np.uint8))
+            if lumenObjects:
+                lumenSlices = lumenObjects[0]
+                # Break the hairy extrusions that connect 'soft' calcification to the lumen.
+                lumenBox = self._binaryOpening(lumenMask[lumenSlices], extrusionKernelSize, spacing)
+                if accountForSoftCalcification:
+                    lumenBox = self._keepLargestIsland(lumenBox)
+                lumenMask[lumenSlices] = lumenBox
+            isLumen = lumenMask[tubeMask]
+        tubeParts[isLumen] = 1
+        minimumCalcificationIntensity = lumenIntensityMax + 1
+        if accountForSoftCalcification:
+            # Grab some intensities that overlap with those of the lumen.
+            minimumCalcificationIntensity = (lumenIntensityMin + lumenIntensityMax) / 2.0
+        isCalcification = (tubeValues >= minimumCalcificationIntensity) & ~isLumen
+        if maskedOutMask is not None:
+            isCalcification &= ~maskedOutMask[tubeMask]
+        tubeParts[isCalcification] = 2
+        partsArray = np.zeros(volumeArray.shape, dtype = np.uint8)
+        partsArray[tubeMask] = tubeParts
+        return partsArray
+
+    def tubeCenterline(self, shapeNode, step):
+        """
+        The centers of the pairs of control points of the tube are joined by a
+        spline, resampled every step mm. Return the points, the tangents, two
+        normals of rotation minimizing frames, and the interpolated radii.
+        """
+        controlPoints = slicer.util.arrayFromMarkupsControlPoints(shapeNode, world = True)
+        numberOfPairs = len(controlPoints) // 2
+        centers = (controlPoints[0:2 * numberOfPairs:2] + controlPoints[1:2 * numberOfPairs:2]) / 2.0
+        radii = np.linalg.norm(controlPoints[0:2 * numberOfPairs:2] - controlPoints[1:2 * numberOfPairs:2], axis = 1) / 2.0
+
+        points = vtk.vtkPoints()
+        for center in centers:
+            points.InsertNextPoint(center)
+        spline = vtk.vtkParametricSpline()
+        spline.SetPoints(points)
+        # Dense samples, then resampled by arc length.
+        numberOfSamples = 20 * numberOfPairs
+        parameters = np.linspace(0.0, 1.0, numberOfSamples)
+        densePoints = np.empty((numberOfSamples, 3))
+        for sampleIndex, parameter in enumerate(parameters):
+            point = [0.0, 0.0, 0.0]
+            spline.Evaluate([parameter, 0.0, 0.0], point, [0.0] * 9)
+            densePoints[sampleIndex] = point
+        denseLengths = np.concatenate(([0.0], np.cumsum(np.linalg.norm(np.diff(densePoints, axis = 0), axis = 1))))
+        arcLengths = np.arange(0.0, denseLengths[-1] + step / 2.0, step)
+        centerlinePoints = np.stack([np.interp(arcLengths, denseLengths, densePoints[:, axis]) for axis in range(3)], axis = 1)
+        # The spline is parameterized by the length of the chords between the centers.
+        chordLengths = np.concatenate(([0.0], np.cumsum(np.linalg.norm(np.diff(centers, axis = 0), axis = 1))))
+        centerlineRadii = np.interp(np.interp(arcLengths, denseLengths, parameters), chordLengths / chordLengths[-1], radii)
+
+        tangents = np.gradient(centerlinePoints, axis = 0)
+        tangents /= np.linalg.norm(tangents, axis = 1)[:, np.newaxis]
+        # Rotation minimizing frames, by double reflection.
+        normals = np.empty_like(tangents)
+        helper = np.eye(3)[np.argmin(np.abs(tangents[0]))]
+        normals[0] = np.cross(tangents[0], helper)
+        normals[0] /= np.linalg.norm(normals[0])
+        for pointIndex in range(len(centerlinePoints) - 1):
+            reflection = centerlinePoints[pointIndex + 1] - centerlinePoints[pointIndex]
+            reflectionSquared = np.dot(reflection, reflection)
+            if reflectionSquared == 0.0:
+                normals[pointIndex + 1] = normals[pointIndex]
+                continue
+            reflectedNormal = normals[pointIndex] - (2.0 / reflectionSquared) * np.dot(reflection, normals[pointIndex]) * reflection
+            reflectedTangent = tangents[pointIndex] - (2.0 / reflectionSquared) * np.dot(reflection, tangents[pointIndex]) * reflection
+            secondReflection = tangents[pointIndex + 1] - reflectedTangent
+            secondReflectionSquared = np.dot(secondReflection, secondReflection)
+            if secondReflectionSquared > 0.0:
+                reflectedNormal -= (2.0 / secondReflectionSquared) * np.dot(secondReflection, reflectedNormal) * secondReflection
+            normals[pointIndex + 1] = reflectedNormal / np.linalg.norm(reflectedNormal)
+        binormals = np.cross(tangents, normals)
+        return centerlinePoints, tangents, normals, binormals, centerlineRadii
+
+    def straightenTube(self, shapeNode, volumeNode):
+        """
+        Resample the bounding box of the tube in cross-sections along its
+        centerline, every smallest voxel spacing. Return a dictionary with
+        the resampled voxels and the mask of the tube, in KJI order, K along
+        the centerline; their spacing in IJK order; and the centerline.
+        It is cached with the tube box.
+        """
+        return self._straightenTubeBox(shapeNode, volumeNode, self._tubeBox(shapeNode, volumeNode))
+
+    def _straightenTubeBox(self, shapeNode, volumeNode, tubeBox):
+        # straightenTube() in tubeBox, of _tubeBox().
+        if "straightenedTube" in tubeBox:
+            return tubeBox["straightenedTube"]
+        step = min(volumeNode.GetSpacing())
+        centerline = self.tubeCenterline(shapeNode, step)
+        centerlinePoints, tangents, normals, binormals, radii = centerline
+        # The cross-sections cover the largest radius.
+        halfSize = int(np.ceil(radii.max() / step)) + 1
+        boxCoordinates = self._crossSectionCoordinates(centerline, step, halfSize, volumeNode, tubeBox["extent"])
+        tubeBox["straightenedTube"] = {
+            "array": ndimage.map_coordinates(tubeBox["array"], boxCoordinates, order = 1,
+                                             mode = "nearest").astype(tubeBox["array"].dtype),
+            "mask": ndimage.map_coordinates(tubeBox["mask"].view(np.uint8), boxCoordinates, order = 0,
+                                            mode = "constant", cval = 0).view(np.bool_),
+            "spacing": (step, step, step),
+            "centerline": centerline,
+        }
+        return tubeBox["straightenedTube"]
+
+    def _boxCoordinates(self, points, volumeNode, extent):
+        # RAS points, as KJI coordinates in the box of extent, along the first axis.
+        rasToIJK = vtk.vtkMatrix4x4()
+        volumeNode.GetRASToIJKMatrix(rasToIJK)
+        rasToIJKArray = slicer.util.arrayFromVTKMatrix(rasToIJK)
+        ijkPoints = np.tensordot(points, rasToIJKArray[:3, :3], axes = ([-1], [1])) + rasToIJKArray[:3, 3]
+        ijkPoints -= (extent[0], extent[2], extent[4])
+        return np.moveaxis(ijkPoints[..., ::-1], -1, 0)
+
+    def _unstraightenLabels(self, straightenedLabels, straightenedTube, ijkToRASArray, tubeExtent, tubeMask):
+        """
+        Map labels of a straightened tube back to the voxels of tubeMask. Each
+        voxel is located in the frame of its nearest centerline point.
+        ijkToRASArray is the IJK to RAS matrix of the volume, as an array.
+        Return the labels in the tube box, and the mask of the tube voxels that
+        fall outside the straightened tube, and so have no label.
+        """
+        from scipy.spatial import cKDTree
+        centerlinePoints, tangents, normals, binormals, radii = straightenedTube["centerline"]
+        step = straightenedTube["spacing"][2]
+        halfSize = (straightenedLabels.shape[1] - 1) // 2
+        voxelIndices = np.argwhere(tubeMask)[:, ::-1] + (tubeExtent[0], tubeExtent[2], tubeExtent[4])
+        voxelPoints = voxelIndices @ ijkToRASArray[:3, :3].T + ijkToRASArray[:3, 3]
+        nearestPoints = cKDTree(centerlinePoints).query(voxelPoints)[1]
+        offsets = voxelPoints - centerlinePoints[nearestPoints]
+        straightenedCoordinates = np.stack([
+            nearestPoints + np.einsum("ij,ij->i", offsets, tangents[nearestPoints]) / step,
+            halfSize + np.einsum("ij,ij->i", offsets, binormals[nearestPoints]) / step,
+            halfSize + np.einsum("ij,ij->i", offsets, normals[nearestPoints]) / step])
+        partsArray = np.zeros(tubeMask.shape, dtype = np.uint8)
+        partsArray[tubeMask] = ndimage.map_coordinates(straightenedLabels, straightenedCoordinates, order = 0,
+                                                       mode = "constant", cval = 0)
+        unmappedMask = np.zeros(tubeMask.shape, dtype = np.bool_)
+        unmappedMask[tubeMask] = ndimage.map_coordinates(straightenedTube["mask"].view(np.uint8), straightenedCoordinates, order = 0,
+                                                         mode = "constant", cval = 0) == 0
+        return partsArray, unmappedMask
+
+    def createCrossSectionProfile(self, shapeNode, volumeNode, segmentationNode, tableNode = None):
+        """
+        Measure the areas of the lumen, calcification and soft lesion segments
+        in the cross-sections of the straightened tube, see straightenTube().
+        The areas and the plaque burden are written in tableNode, or a new
+        table node, along the distance on the centerline, and plotted.
+        Return the table node.
+        """
+        distances, areas = self.crossSectionAreas(shapeNode, volumeNode, segmentationNode)
+        segmentAreas = sum(areas)
+        plaqueBurden = np.divide(100.0 * (areas[1] + areas[2]), segmentAreas,
+                                 out = np.zeros_like(segmentAreas), where = segmentAreas > 0)
+        if not tableNode:
+            tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", shapeNode.GetName() + "_Profile")
+        columnNames = ["Distance (mm)"] + [f"{partName} area (mm2)" for partName in self.partNames] + ["Plaque burden (%)"]
+        slicer.util.updateTableFromArray(tableNode, [distances] + list(areas) + [plaqueBurden], columnNames)
+
+        # The chart and the series of a table that is updated again are reused.
+        seriesNodes = {seriesNode.GetYColumnName(): seriesNode
+                       for seriesNode in slicer.util.getNodesByClass("vtkMRMLPlotSeriesNode")
+                       if seriesNode.GetTableNodeID() == tableNode.GetID()}
+        chartNode = next((chartNode for chartNode in slicer.util.getNodesByClass("vtkMRMLPlotChartNode")
+                          if any(chartNode.HasPlotSeriesNodeID(seriesNode.GetID()) for seriesNode in seriesNodes.values())), None)
+        if not chartNode:
+            chartNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotChartNode", shapeNode.GetName() + "_Profile")
+        chartNode.SetTitle(shapeNode.GetName())
+        chartNode.SetXAxisTitle(columnNames[0])
+        chartNode.SetYAxisTitle("Area (mm2)")
+        for columnName in columnNames[1:-1]:
+            seriesNode = seriesNodes.get(columnName)
+            if not seriesNode:
+                seriesNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotSeriesNode", columnName)
+                seriesNode.SetAndObserveTableNodeID(tableNode.GetID())
+                seriesNode.SetYColumnName(columnName)
+            seriesNode.SetXColumnName(columnNames[0])
+            seriesNode.SetPlotType(slicer.vtkMRMLPlotSeriesNode.PlotTypeLine)
+            seriesNode.SetMarkerStyle(slicer.vtkMRMLPlotSeriesNode.MarkerStyleNone)
+            if not chartNode.HasPlotSeriesNodeID(seriesNode.GetID()):
+                chartNode.AddAndObservePlotSeriesNodeID(seriesNode.GetID())
+        slicer.modules.plots.logic().ShowChartInLayout(chartNode)
+        return tableNode
+
+    def crossSectionAreas(self, shapeNode, volumeNode, segmentationNode):
+        """
+        Return the distances of the cross-sections on the centerline of the
+        tube, and for each of partNames, the areas of the segment in them, in mm2.
+        The segments are resampled in the cross-sections all at once.
+        The segments of shapeNode are found by _partSegmentIDs().
+        """
+        straightenedTube = self.straightenTube(shapeNode, volumeNode)
+        step = straightenedTube["spacing"][2]
+        numberOfCrossSections = straightenedTube["mask"].shape[0]
+        tubeBox = self._tubeBox(shapeNode, volumeNode)
+        tubeImage = self._orientedImage(volumeNode, tubeBox["extent"])
+        halfSize = (straightenedTube["mask"].shape[1] - 1) // 2
+        crossSectionCoordinates = self._crossSectionCoordinates(straightenedTube["centerline"], step, halfSize,
+                                                                volumeNode, tubeBox["extent"])
+        areas = []
+        for segmentID in self._partSegmentIDs(segmentationNode, shapeNode):
+            segmentMask = self._segmentMask(segmentationNode, segmentID, tubeImage) if segmentID else None
+            if segmentMask is None:
+                areas.append(np.zeros(numberOfCrossSections))
+                continue
+            # Only the cross-sections inside the tube are measured.
+            crossSectionMask = ndimage.map_coordinates(segmentMask.view(np.uint8), crossSectionCoordinates, order = 0,
+                                                       mode = "constant", cval = 0).view(np.bool_)
+            crossSectionMask &= straightenedTube["mask"]
+            areas.append(np.count_nonzero(crossSectionMask, axis = (1, 2)) * step * step)
+        return np.arange(numberOfCrossSections) * step, areas
+
+    def createCalciumScoreTable(self, volumeNode, segmentationNode, tableNode = None, massCalibrationFactor = 1.0):
+        """
+        Score the 'Calcification' segments, those of process() and of
+        processTubes(), see calciumScores(). One row per segment is written in
+        tableNode, or a new table node: the totals, then the Agatston score of
+        each slice, along K, that has calcium in any segment. Return the table
+        node.
+        """
+        segmentation = segmentationNode.GetSegmentation()
+        segmentIDs = [segmentID for segmentID in segmentation.GetSegmentIDs()
+                      if segmentation.GetSegment(segmentID).GetName() == self.partNames[1]
+                      or segmentation.GetSegment(segmentID).GetName().endswith(" " + self.partNames[1])]
+        if not segmentIDs:
+            raise ValueError("No calcification segment found.")
+        scores = [self.calciumScores(volumeNode, segmentationNode, segmentID, massCalibrationFactor)
+                  for segmentID in segmentIDs]
+
+        if not tableNode:
+            tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", segmentationNode.GetName() + "_CalciumScore")
+        tableNode.RemoveAllColumns()
+        segmentNames = vtk.vtkStringArray()
+        segmentNames.SetName("Segment")
+        for segmentID in segmentIDs:
+            segmentNames.InsertNextValue(segmentation.GetSegment(segmentID).GetName())
+        tableNode.AddColumn(segmentNames)
+        for columnName, key in (("Agatston score", "agatstonScore"), ("Volume (mm3)", "volume"),
+                                ("Mass (mg)", "mass"), ("Lesions", "numberOfLesions")):
+            column = numpy_support.numpy_to_vtk(np.array([segmentScores[key] for segmentScores in scores], dtype = np.float64), deep = 1)
+            column.SetName(columnName)
+            tableNode.AddColumn(column)
+        sliceScores = np.array([segmentScores["sliceScores"] for segmentScores in scores])
+        for sliceIndex in np.flatnonzero(sliceScores.any(axis = 0)):
+            column = numpy_support.numpy_to_vtk(sliceScores[:, sliceIndex].copy(), deep = 1)
+            column.SetName(f"Slice {sliceIndex} score")
+            tableNode.AddColumn(column)
+        return tableNode
+
+    def calciumScores(self, volumeNode, segmentationNode, segmentID, massCalibrationFactor = 1.0,
+                      intensityThreshold = 130.0, minimumLesionAreaMm2 = 1.0):
+        """
+        Calcium scores of a segment, from the voxels of volumeNode in Hounsfield
+        units, at or above intensityThreshold. The slices are along the K axis.
+        In each slice, the lesions are the 8-connected groups of voxels, with
+        an area of minimumLesionAreaMm2 at least; all slices are labeled at once.
+        The Agatston score of a lesion is its area in mm2, weighted by its
+        highest intensity: 1 from 130, 2 from 200, 3 from 300 and 4 from 400;
+        it is scaled by the slice thickness over 3 mm.
+        The mass in mg is massCalibrationFactor, in mg/cm3 per HU, from a
+        phantom scan, times the volume and the mean intensity of the lesions.
+        Return a dictionary with the Agatston score, the score of each
+        slice, the volume in mm3, the mass and the number of 3D lesions.
+        """
+        spacing = volumeNode.GetSpacing()
+        volumeExtent = volumeNode.GetImageData().GetExtent()
+        scores = {
+            "agatstonScore": 0.0,
+            "sliceScores": np.zeros(volumeExtent[5] - volumeExtent[4] + 1),
+            "volume": 0.0,
+            "mass": 0.0,
+            "numberOfLesions": 0,
+        }
+        segmentImage = slicer.vtkOrientedImageData()
+        segmentationNode.GetBinaryLabelmapRepresentation(segmentID, segmentImage)
+        if segmentImage.IsEmpty():
+            return scores
+        segmentBounds = [0.0] * 6
+        segmentImage.GetBounds(segmentBounds)
+        extent = self._boundsExtent(segmentBounds, volumeNode)
+        if extent is None:
+            return scores
+        segmentMask = self._segmentMask(segmentationNode, segmentID, self._orientedImage(volumeNode, extent))
+        if segmentMask is None:
+            return scores
+        boxArray = slicer.util.arrayFromVolume(volumeNode)[self._extentSlices(extent)]
+        calciumMask = segmentMask & (boxArray >= intensityThreshold)
+
+        # A structure in the middle slice only: the lesions of each slice are distinct.
+        sliceStructure = np.zeros((3, 3, 3), dtype = np.bool_)
+        sliceStructure[1] = True
+        lesionLabels, numberOfSliceLesions = ndimage.label(calciumMask, structure = sliceStructure)
+        if numberOfSliceLesions == 0:
+            return scores
+        lesionIndices = np.arange(1, numberOfSliceLesions + 1)
+        calciumLabels = lesionLabels[calciumMask]
+        lesionAreas = np.bincount(calciumLabels, minlength = numberOfSliceLesions + 1)[1:] * spacing[0] * spacing[1]
+        lesionWeights = np.digitize(ndimage.maximum(boxArray, lesionLabels, lesionIndices), (200.0, 300.0, 400.0)) + 1
+        lesionSlices = np.empty(numberOfSliceLesions, dtype = np.intp)
+        lesionSlices[calciumLabels - 1] = np.nonzero(calciumMask)[0]
+        isLesion = lesionAreas >= minimumLesionAreaMm2
+        lesionScores = np.where(isLesion, lesionAreas * lesionWeights, 0.0) * spacing[2] / 3.0
+        scores["sliceScores"][extent[4] - volumeExtent[4]:extent[5] - volumeExtent[4] + 1] = np.bincount(
+            lesionSlices, weights = lesionScores, minlength = extent[5] - extent[4] + 1)
+        scores["agatstonScore"] = float(lesionScores.sum())
+
+        # The lesions below the minimum area are not counted.
+        calciumMask[calciumMask] = isLesion[calciumLabels - 1]
+        voxelVolume = spacing[0] * spacing[1] * spacing[2]
+        scores["volume"] = float(np.count_nonzero(calciumMask) * voxelVolume)
+        scores["mass"] = float(massCalibrationFactor * boxArray[calciumMask].sum(dtype = np.float64) * voxelVolume / 1000.0)
+        scores["numberOfLesions"] = ndimage.label(calciumMask, structure = np.ones((3, 3, 3), dtype = np.bool_))[1]
+        return scores
+
+    def _crossSectionCoordinates(self, centerline, step, halfSize, volumeNode, extent):
+        # Coordinates in the box of extent of square cross-sections along the centerline, of halfSize voxels.
+        centerlinePoints, tangents, normals, binormals, radii = centerline
+        offsets = np.arange(-halfSize, halfSize + 1) * step
+        # Points of the cross-sections, as (centerline, binormal, normal, RAS).
+        crossSectionPoints = (centerlinePoints[:, np.newaxis, np.newaxis, :]
+                              + offsets[np.newaxis, :, np.newaxis, np.newaxis] * binormals[:, np.newaxis, np.newaxis, :]
+                              + offsets[np.newaxis, np.newaxis, :, np.newaxis] * normals[:, np.newaxis, np.newaxis, :])
+        return self._boxCoordinates(crossSectionPoints, volumeNode, extent)
+
+    def createTubeVolume(self, shapeNode, volumeNode, marginMm = 0.0):
+        """
+        Create a scalar volume node of the voxels of volumeNode within the
+        bounding box of the tube, padded by marginMm. Outside the tube, it is
+        filled with an intensity that does not exist in volumeNode, as
+        'Split volume' would do, but the whole volume is not copied.
+        """
+        tubeBox = self._tubeBox(shapeNode, volumeNode, marginMm)
+        if "fillValue" not in tubeBox:
+            volumeArray = slicer.util.arrayFromVolume(volumeNode)
+            fillValue = volumeArray.min() - 1
+            if np.issubdtype(volumeArray.dtype, np.integer):
+                fillValue = max(fillValue, np.iinfo(volumeArray.dtype).min)
+            tubeBox["fillValue"] = volumeArray.dtype.type(fillValue)
+        tubeArray = np.where(tubeBox["mask"], tubeBox["array"], tubeBox["fillValue"])
+        return self._createBoxVolumeNode("vtkMRMLScalarVolumeNode", volumeNode.GetName() + "_Tube", volumeNode, tubeBox["extent"], tubeArray)
+
+    def _tubeBox(self, shapeNode, volumeNode, marginMm = 0.0):
+        """
+        Return a dictionary with the extent of the bounding box of the tube,
+        the mask of the tube and a copy of the voxels within, in KJI order.
+        It is cached, and reused until the control points of the tube, or the
+        voxels or the geometry of the volume change. Values derived from the
+        box may be added to it, they are cached alike. The cache holds
+        tubeBoxCacheBytes at most, counted when a box is used, a single box
+        larger than that is not kept.
+        """
+        key = self._tubeBoxKey(shapeNode, volumeNode, marginMm)
+        tubeBox = self._tubeBoxCache.pop(key, None)
+        if tubeBox is None:
+            tubeExtent = self.tubeExtent(shapeNode, volumeNode, marginMm)
+            tubeBox = {
+                "extent": tubeExtent,
+                "mask": self.rasterizeTube(shapeNode, volumeNode, tubeExtent),
+                "array": slicer.util.arrayFromVolume(volumeNode)[self._extentSlices(tubeExtent)].copy(),
+            }
+        # The most recently used is last, the least recently used is dropped.
+        self._tubeBoxCache[key] = tubeBox
+        cachedBytes = sum(self._cachedBytes(cachedBox) for cachedBox in self._tubeBoxCache.values())
+        while cachedBytes > self.tubeBoxCacheBytes:
+            cachedBytes -= self._cachedBytes(self._tubeBoxCache.pop(next(iter(self._tubeBoxCache))))
+        return tubeBox
+
+    def _cachedBytes(self, value):
+        # Bytes of the arrays of a cached value, within its dictionaries, lists and tuples.
+        if isinstance(value, np.ndarray):
+            return value.nbytes
+        if isinstance(value, dict):
+            value = list(value.values())
+        if isinstance(value, (list, tuple)):
+            return sum(self._cachedBytes(item) for item in value)
+        return 0
+
+    def _tubeBoxKey(self, shapeNode, volumeNode, marginMm):
+        # The fill value derives from the voxels, it is covered by their modified time.
+        controlPoints = slicer.util.arrayFromMarkupsControlPoints(shapeNode, world = True)
+        ijkToRAS = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        return (shapeNode.GetID(), controlPoints.tobytes(),
+                volumeNode.GetID(), volumeNode.GetImageData().GetMTime(),
+                tuple(ijkToRAS.GetElement(row, column) for row in range(3) for column in range(4)),
+                marginMm)
+
+    def clearTubeBoxCache(self):
+        self._tubeBoxCache.clear()
+
+    def _createBoxVolumeNode(self, className, name, volumeNode, extent, boxArray):
+        # A volume node of boxArray, in the geometry of volumeNode within extent.
+        boxVolumeNode = slicer.mrmlScene.AddNewNodeByClass(className, name)
+        ijkToRAS = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        boxOrigin = ijkToRAS.MultiplyPoint((extent[0], extent[2], extent[4], 1.0))
+        boxVolumeNode.SetIJKToRASMatrix(ijkToRAS)
+        boxVolumeNode.SetOrigin(boxOrigin[:3])
+        slicer.util.updateVolumeFromArray(boxVolumeNode, boxArray)
+        boxVolumeNode.SetAndObserveTransformNodeID(volumeNode.GetTransformNodeID())
+        boxVolumeNode.CreateDefaultDisplayNodes()
+        # Keep it beside the input volume.
+        shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+        shNode.SetItemParent(shNode.GetItemByDataNode(boxVolumeNode), shNode.GetItemParent(shNode.GetItemByDataNode(volumeNode)))
+        return boxVolumeNode
+
+    def createPreviewLabelMap(self, shapeNode, volumeNode):
+        """
+        Create an empty label map volume node of the bounding box of the tube,
+        and an index of the intensities of the voxels inside the tube.
+        The index is a pair of arrays: the intensities in ascending order, and
+        the flat indices of their voxels in the label map. See updatePreviewLabelMap().
+        """
+        tubeBox = self._tubeBox(shapeNode, volumeNode)
+        tubeMask = tubeBox["mask"]
+        if "intensityIndex" not in tubeBox:
+            tubeValues = tubeBox["array"][tubeMask]
+            tubeIndices = np.flatnonzero(tubeMask)
+            order = np.argsort(tubeValues, kind = "stable")
+            tubeBox["intensityIndex"] = (tubeValues[order], tubeIndices[order])
+        previewLabelMapNode = self._createBoxVolumeNode("vtkMRMLLabelMapVolumeNode", "LumenPreview", volumeNode,
+                                                        tubeBox["extent"], np.zeros(tubeMask.shape, dtype = np.uint8))
+        return previewLabelMapNode, tubeBox["intensityIndex"]
+
+    def updatePreviewLabelMap(self, previewLabelMapNode, intensityIndex, previousRange, intensityMin, intensityMax):
+        """
+        Label the voxels of intensityIndex within [intensityMin, intensityMax]
+        in previewLabelMapNode. The intensities are sorted: the voxels within
+        are a range of the index, found by bisection. Only the voxels whose
+        intensities are between the previous and the new bounds are written.
+        previousRange is the range returned by the previous call, or (0, 0).
+        Return the new range; its length is the number of voxels.
+        """
+        sortedValues, sortedIndices = intensityIndex
+        start = int(np.searchsorted(sortedValues, intensityMin, side = "left"))
+        stop = int(np.searchsorted(sortedValues, intensityMax, side = "right"))
+        previousStart, previousStop = previousRange
+        previewArray = slicer.util.arrayFromVolume(previewLabelMapNode).reshape(-1)
+        if start >= previousStop or stop <= previousStart:
+            previewArray[sortedIndices[previousStart:previousStop]] = 0
+            previewArray[sortedIndices[start:stop]] = 1
+        else:
+            # Empty slices where a bound did not move in that direction.
+            previewArray[sortedIndices[start:previousStart]] = 1
+            previewArray[sortedIndices[previousStart:start]] = 0
+            previewArray[sortedIndices[stop:previousStop]] = 0
+            previewArray[sortedIndices[previousStop:stop]] = 1
+        slicer.util.arrayFromVolumeModified(previewLabelMapNode)
+        return start, stop
+
+    def tubeExtent(self, shapeNode, volumeNode, marginMm = 0.0):
+        """
+        IJK extent of the voxels of volumeNode within the bounding box of the
+        tube, padded by marginMm and by one voxel.
+        """
+        tubeExtent = self._boundsExtent(shapeNode.GetCappedTubeWorld().GetBounds(), volumeNode, marginMm)
+        if tubeExtent is None:
+            raise ValueError("The tube is outside the volume.")
+        return tubeExtent
+
+    def _boundsExtent(self, bounds, volumeNode, marginMm = 0.0):
+        # IJK extent of the voxels of volumeNode within RAS bounds, padded by marginMm and one voxel, or None.
+        rasToIJK = vtk.vtkMatrix4x4()
+        volumeNode.GetRASToIJKMatrix(rasToIJK)
+        cornersIJK = np.array([rasToIJK.MultiplyPoint((r, a, s, 1.0))[:3]
+                               for r in (bounds[0] - marginMm, bounds[1] + marginMm)
+                               for a in (bounds[2] - marginMm, bounds[3] + marginMm)
+                               for s in (bounds[4] - marginMm, bounds[5] + marginMm)])
+        volumeExtent = volumeNode.GetImageData().GetExtent()
+        extent = []
+        for axis in range(3):
+            extent.append(max(int(np.floor(cornersIJK[:, axis].min())) - 1, volumeExtent[2 * axis]))
+            extent.append(min(int(np.ceil(cornersIJK[:, axis].max())) + 1, volumeExtent[2 * axis + 1]))
+        if any(extent[2 * axis] > extent[2 * axis + 1] for axis in range(3)):
+            return None
+        return extent
+
+    def _extentSlices(self, extent):
+        # Slices of a voxel array in KJI order.
+        return tuple(slice(extent[2 * axis], extent[2 * axis + 1] + 1) for axis in (2, 1, 0))
+
+    def rasterizeTube(self, shapeNode, volumeNode, extent = None):
+        """
+        Voxels of volumeNode inside the capped tube, as a boolean array in KJI
+        order, within extent in IJK, or the whole volume.
+        """
+        rasToIJK = vtk.vtkMatrix4x4()
+        volumeNode.GetRASToIJKMatrix(rasToIJK)
+        rasToIJKTransform = vtk.vtkTransform()
+        rasToIJKTransform.SetMatrix(rasToIJK)
+        transformFilter = vtk.vtkTransformPolyDataFilter()
+        transformFilter.SetInputData(shapeNode.GetCappedTubeWorld())
+        transformFilter.SetTransform(rasToIJKTransform)
+        polyDataToStencil = vtk.vtkPolyDataToImageStencil()
+        polyDataToStencil.SetInputConnection(transformFilter.GetOutputPort())
+        polyDataToStencil.SetOutputOrigin(0.0, 0.0, 0.0)
+        polyDataToStencil.SetOutputSpacing(1.0, 1.0, 1.0)
+        polyDataToStencil.SetOutputWholeExtent(extent if extent is not None else volumeNode.GetImageData().GetExtent())
+        stencilToImage = vtk.vtkImageStencilToImage()
+        stencilToImage.SetInputConnection(polyDataToStencil.GetOutputPort())
+        stencilToImage.SetInsideValue(1)
+        stencilToImage.SetOutsideValue(0)
+        stencilToImage.SetOutputScalarType(vtk.VTK_UNSIGNED_CHAR)
+        stencilToImage.Update()
+        tubeImage = stencilToImage.GetOutput()
+        tubeArray = numpy_support.vtk_to_numpy(tubeImage.GetPointData().GetScalars())
+        return tubeArray.reshape(tubeImage.GetDimensions()[::-1]).astype(np.bool_)
+
+    def _orientedImage(self, volumeNode, extent):
+        # An empty uint8 labelmap in the geometry of volumeNode, within extent.
+        ijkToRAS = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        orientedImage = slicer.vtkOrientedImageData()
+        orientedImage.SetImageToWorldMatrix(ijkToRAS)
+        orientedImage.SetExtent(extent)
+        orientedImage.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+        orientedImage.GetPointData().GetScalars().Fill(0)
+        return orientedImage
+
+    def _imageArray(self, image):
+        # Voxel array of a vtkImageData in KJI order, sharing its memory.
+        return numpy_support.vtk_to_numpy(image.GetPointData().GetScalars()).reshape(image.GetDimensions()[::-1])
+
+    def _segmentMask(self, segmentationNode, segmentID, referenceImage):
+        # A segment resampled to the extent of referenceImage, or None if it is empty.
+        # Without padding, the mask has the shape of the reference array even if
+        # the segment extends beyond it.
+        segmentImage = slicer.vtkOrientedImageData()
+        segmentationNode.GetBinaryLabelmapRepresentation(segmentID, segmentImage)
+        if segmentImage.IsEmpty():
+            return None
+        resampledImage = slicer.vtkOrientedImageData()
+        if not slicer.vtkOrientedImageDataResample.ResampleOrientedImageToReferenceOrientedImage(segmentImage, referenceImage, resampledImage, False, False):
+            return None
+        return self._imageArray(resampledImage) > 0
+
+    def _segmentsMask(self, segmentationNode, referenceImage):
+        # Union of all segments in the geometry of referenceImage, or None.
+        segmentsMask = None
+        for segmentID in segmentationNode.GetSegmentation().GetSegmentIDs():
+            segmentArray = self._segmentMask(segmentationNode, segmentID, referenceImage)
+            if segmentArray is None:
+                continue
+            if segmentsMask is None:
+                segmentsMask = segmentArray
+            else:
+                segmentsMask |= segmentArray
+        return segmentsMask
+
+    def _openingKernel(self, kernelSizeMm, spacing):
+        # Ellipsoid in KJI order, with odd sizes in voxels, as the 'Smoothing' effect.
+        kernelSize = [max(int(round((kernelSizeMm / axisSpacing + 1) / 2)) * 2 - 1, 1) for axisSpacing in spacing[::-1]]
+        radius = [(axisSize - 1) // 2 for axisSize in kernelSize]
+        grid = np.ogrid[tuple(slice(-axisRadius, axisRadius + 1) for axisRadius in radius)]
+        squaredDistance = sum(((axisGrid / axisRadius) ** 2 for axisGrid, axisRadius in zip(grid, radius) if axisRadius), np.zeros(kernelSize))
+        return squaredDistance <= 1.0
+
+    def _binaryOpening(self, mask, kernelSizeMm, spacing):
+        """
+        Opening of mask by the kernel of _openingKernel(), outside being
+        background. With large kernels, the erosion and the dilation are
+        thresholds of distance transforms scaled by the radii of the kernel,
+        whose cost does not grow with its size.
+        """
+        kernel = self._openingKernel(kernelSizeMm, spacing)
+        # Measured crossover: a kernel of radius 3 voxels is still faster directly.
+        if np.count_nonzero(kernel) <= 256:
+            return ndimage.binary_opening(mask, structure = kernel)
+        radius = [(axisSize - 1) // 2 for axisSize in kernel.shape]
+        # An axis without radius is not crossed by the kernel.
+        sampling = [1.0 / axisRadius if axisRadius else float(sum(mask.shape)) for axisRadius in radius]
+        # Tolerance for the rounding of the distances on the kernel surface.
+        threshold = 1.0 + 1e-9
+        paddedMask = np.pad(mask, 1)
+        erodedMask = ndimage.distance_transform_edt(paddedMask, sampling = sampling) > threshold
+        if not erodedMask.any():
+            return np.zeros_like(mask)
+        openedMask = ndimage.distance_transform_edt(~erodedMask, sampling = sampling) <= threshold
+        return openedMask[1:-1, 1:-1, 1:-1]
+
+    def _keepLargestIsland(self, mask):
+        # Face connectivity, as the 'Islands' effect.
+        labels, numberOfLabels = ndimage.label(mask)
+        if numberOfLabels < 2:
+            return mask
+        sizes = np.bincount(labels.ravel())
+        sizes[0] = 0
+        return labels == sizes.argmax()
 
 
 #
@@ -599,8 +1479,157 @@ class ArteryPartsSegmentationTest(ScriptedLoadableModuleTest):
         """
         self.setUp()
         self.test_ArteryPartsSegmentation1()
+        self.setUp()
+        self.test_PreviewLabelMap()
+        self.setUp()
+        self.test_StraightenedTubeCaps()
+        self.setUp()
+        self.test_ProcessTubesBookkeeping()
+        self.setUp()
+        self.test_BinaryOpening()
+        self.setUp()
+        self.test_CalciumScores()
 
     def test_ArteryPartsSegmentation1(self):
         self.delayDisplay("Starting the test")
 
         self.delayDisplay('Test passed')
+
+    def test_PreviewLabelMap(self):
+        # Successive ranges, overlapping or not, label the same voxels as a threshold.
+        self.delayDisplay("Starting the test")
+        rng = np.random.default_rng(0)
+        volumeArray = rng.integers(-100, 600, (10, 20, 30)).astype(np.int16)
+        tubeMask = rng.random(volumeArray.shape) < 0.5
+        tubeValues = volumeArray[tubeMask]
+        order = np.argsort(tubeValues, kind = "stable")
+        intensityIndex = (tubeValues[order], np.flatnonzero(tubeMask)[order])
+        previewLabelMapNode = slicer.util.addVolumeFromArray(np.zeros(volumeArray.shape, dtype = np.uint8),
+                                                             nodeClassName = "vtkMRMLLabelMapVolumeNode")
+
+        logic = ArteryPartsSegmentationLogic()
+        previousRange = (0, 0)
+        for intensityMin, intensityMax in ((200, 450), (150, 400), (250, 500), (500, 550), (0, 100), (300, 300)):
+            previousRange = logic.updatePreviewLabelMap(previewLabelMapNode, intensityIndex, previousRange, intensityMin, intensityMax)
+            expectedMask = tubeMask & (volumeArray >= intensityMin) & (volumeArray <= intensityMax)
+            self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(previewLabelMapNode) > 0, expectedMask))
+            self.assertEqual(previousRange[1] - previousRange[0], np.count_nonzero(expectedMask))
+        self.delayDisplay('Test passed')
+
+    def test_StraightenedTubeCaps(self):
+        # The voxels of the caps, past the ends of the centerline, are classified by their
+        # intensity alone, the rest of the tube is not classified again.
+        self.delayDisplay("Starting the test")
+        kk, jj, ii = np.mgrid[0:30, 0:21, 0:21]
+        squaredRadii = (ii - 10) ** 2 + (jj - 10) ** 2
+        tubeMask = (squaredRadii <= 25) & (kk >= 2) & (kk <= 27)
+        volumeArray = np.where(squaredRadii <= 9, 300, 100).astype(np.int16)
+        volumeArray[15, 10, 14] = 600
+        volumeNode = slicer.util.addVolumeFromArray(volumeArray)
+        ijkToRAS = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        ijkToRASArray = slicer.util.arrayFromVTKMatrix(ijkToRAS)
+        extent = [0, 20, 0, 20, 0, 29]
+
+        # A straight centerline from slice 5 to slice 24.
+        numberOfPoints = 20
+        centerlinePoints = np.column_stack([np.full(numberOfPoints, 10.0), np.full(numberOfPoints, 10.0),
+                                            np.arange(5.0, 5.0 + numberOfPoints)]) @ ijkToRASArray[:3, :3].T + ijkToRASArray[:3, 3]
+        tangents, normals, binormals = (np.tile(ijkToRASArray[:3, axis], (numberOfPoints, 1)) for axis in (2, 0, 1))
+        centerline = (centerlinePoints, tangents, normals, binormals, np.full(numberOfPoints, 5.0))
+        logic = ArteryPartsSegmentationLogic()
+        boxCoordinates = logic._crossSectionCoordinates(centerline, 1.0, 6, volumeNode, extent)
+        straightenedTube = {
+            "array": ndimage.map_coordinates(volumeArray, boxCoordinates, order = 0, mode = "nearest"),
+            "mask": ndimage.map_coordinates(tubeMask.view(np.uint8), boxCoordinates, order = 0).view(np.bool_),
+            "spacing": (1.0, 1.0, 1.0),
+            "centerline": centerline,
+        }
+        tubeTask = {"extent": extent, "mask": tubeMask, "array": volumeArray, "spacing": (1.0, 1.0, 1.0),
+                    "ijkToRAS": ijkToRASArray, "straightenedTube": straightenedTube, "otherSegmentsMask": None}
+
+        classifiedMasks = []
+        classifyTubeVoxels = logic.classifyTubeVoxels
+        def recordClassifiedMask(volumeArray, tubeMask, *args, **kwargs):
+            classifiedMasks.append(tubeMask)
+            return classifyTubeVoxels(volumeArray, tubeMask, *args, **kwargs)
+        logic.classifyTubeVoxels = recordClassifiedMask
+        partsArray = logic._classifyTube(tubeTask, 200.0, 450.0, True, 1.0)
+
+        capMask = tubeMask & ((kk < 5) | (kk > 24))
+        self.assertEqual(len(classifiedMasks), 2)
+        self.assertTrue(np.array_equal(classifiedMasks[1], capMask))
+        expectedParts = np.zeros(volumeArray.shape, dtype = np.uint8)
+        expectedParts[tubeMask] = np.where(squaredRadii <= 9, 1, 3)[tubeMask]
+        expectedParts[15, 10, 14] = 2
+        self.assertTrue(np.array_equal(partsArray, expectedParts))
+        self.delayDisplay('Test passed')
+
+    def test_ProcessTubesBookkeeping(self):
+        # processTubes() runs overlapping tubes in successive waves, in order, and finds
+        # the segments of each tube by its tag.
+        self.delayDisplay("Starting the test")
+        logic = ArteryPartsSegmentationLogic()
+        extents = [[0, 5, 0, 5, 0, 5], [6, 9, 0, 5, 0, 5], [3, 7, 0, 5, 0, 5], [0, 1, 0, 1, 0, 1], [20, 30, 0, 1, 0, 1]]
+        self.assertEqual(logic._disjointWaves(extents), [[0, 1, 4], [2, 3]])
+
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+        segmentation = segmentationNode.GetSegmentation()
+        shapeNodes = [slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", name) for name in ("Left", "Right")]
+        segmentation.AddEmptySegment(logic.partNames[0])
+        for shapeNode in shapeNodes:
+            for partName in logic.partNames[:2]:
+                segmentID = segmentation.AddEmptySegment(f"{shapeNode.GetName()} {partName}")
+                segmentation.GetSegment(segmentID).SetTag(logic.tagSourceShapeId, vtk.reference(shapeNode.GetID()))
+        for shapeNode in shapeNodes:
+            segmentIDs = logic._partSegmentIDs(segmentationNode, shapeNode)
+            self.assertEqual([segmentation.GetSegment(segmentID).GetName() if segmentID else None for segmentID in segmentIDs],
+                             [f"{shapeNode.GetName()} {logic.partNames[0]}", f"{shapeNode.GetName()} {logic.partNames[1]}", None])
+        logic._removeSourceShapeSegments(segmentationNode, shapeNodes[0])
+        self.assertEqual(segmentation.GetNumberOfSegments(), 3)
+        self.delayDisplay('Test passed')
+
+    def test_BinaryOpening(self):
+        # The distance transforms of large kernels give the opening by the kernel.
+        self.delayDisplay("Starting the test")
+        logic = ArteryPartsSegmentationLogic()
+        randomMask = ndimage.gaussian_filter(np.random.default_rng(0).random((40, 50, 60)), 2) > 0.5
+        for kernelSizeMm, spacing in ((1.0, (0.5, 0.5, 0.5)), (5.0, (0.5, 0.5, 0.5)), (3.0, (0.4, 0.4, 1.0))):
+            kernel = logic._openingKernel(kernelSizeMm, spacing)
+            openedMask = logic._binaryOpening(randomMask, kernelSizeMm, spacing)
+            self.assertTrue(np.array_equal(openedMask, ndimage.binary_opening(randomMask, structure = kernel)))
+        self.delayDisplay('Test passed')
+
+    def test_CalciumScores(self):
+        self.delayDisplay("Starting the test")
+        volumeArray = np.zeros((8, 40, 40), dtype = np.int16)
+        # Weight 2, 4 mm2, and weight 4, 1 mm2, in slices 3 mm thick.
+        volumeArray[2, 10:14, 10:14] = 250
+        volumeArray[3, 20:22, 20:22] = 450
+        # Smaller than 1 mm2.
+        volumeArray[5, 25, 25] = 500
+        # Outside of the segment.
+        volumeArray[2, 35, 35] = 900
+        volumeNode = slicer.util.addVolumeFromArray(volumeArray)
+        volumeNode.SetSpacing(0.5, 0.5, 3.0)
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+        segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(volumeNode)
+        segmentID = segmentationNode.GetSegmentation().AddEmptySegment("Calcification")
+        segmentArray = np.zeros(volumeArray.shape, dtype = np.uint8)
+        segmentArray[:, 5:30, 5:30] = 1
+        slicer.util.updateSegmentBinaryLabelmapFromArray(segmentArray, segmentationNode, segmentID, volumeNode)
+
+        logic = ArteryPartsSegmentationLogic()
+        scores = logic.calciumScores(volumeNode, segmentationNode, segmentID)
+        self.assertAlmostEqual(scores["agatstonScore"], 12.0)
+        self.assertTrue(np.allclose(scores["sliceScores"], [0, 0, 8, 4, 0, 0, 0, 0]))
+        self.assertAlmostEqual(scores["volume"], 15.0)
+        self.assertAlmostEqual(scores["mass"], (16 * 250 + 4 * 450) * 0.75 / 1000.0)
+        self.assertEqual(scores["numberOfLesions"], 2)
+
+        tableNode = logic.createCalciumScoreTable(volumeNode, segmentationNode)
+        self.assertEqual([tableNode.GetColumnName(columnIndex) for columnIndex in range(tableNode.GetNumberOfColumns())],
+                         ["Segment", "Agatston score", "Volume (mm3)", "Mass (mg)", "Lesions", "Slice 2 score", "Slice 3 score"])
+        self.assertAlmostEqual(float(tableNode.GetCellText(0, 5)), 8.0)
+        self.assertAlmostEqual(float(tableNode.GetCellText(0, 6)), 4.0)
+        self.delayDisplay('Test passed')
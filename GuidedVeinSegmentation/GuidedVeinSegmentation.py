@@ -3,6 +3,9 @@ import os
 from typing import Annotated, Optional
 
 import vtk
+from vtk.util import numpy_support
+import numpy as np
+from scipy import ndimage
 
 import slicer
 from slicer.ScriptedLoadableModule import *
@@ -147,6 +150,7 @@ class GuidedVeinSegmentationWidget(ScriptedLoadableModuleWidget, VTKObservationM
         """
         # Parameter node will be reset, do not use it anymore
         self.setParameterNode(None)
+        self.logic.clearDistanceMapCache()
 
     def onSceneEndClose(self, caller, event) -> None:
         """
@@ -218,11 +222,15 @@ class GuidedVeinSegmentationLogic(ScriptedLoadableModuleLogic):
     https://github.com/Slicer/Slicer/blob/main/Base/Python/slicer/ScriptedLoadableModule.py
     """
 
+    # Bytes of the distance maps kept by curveDistanceMap(): the shell and the seeds of a few runs.
+    distanceMapCacheBytes = 256 * 1024**2
+
     def __init__(self) -> None:
         """
         Called when the logic class is instantiated. Can be used for initializing member variables.
         """
         ScriptedLoadableModuleLogic.__init__(self)
+        self._distanceMapCache = {}
 
     def getParameterNode(self):
         return GuidedVeinSegmentationParameterNode(super().getParameterNode())
@@ -238,8 +246,34 @@ class GuidedVeinSegmentationLogic(ScriptedLoadableModuleLogic):
                 shellThickness: float = 2.0,
                 subtractOtherSegments: bool = True) -> None:
 
-        if not inputCurve or not inputVolume or not inputSegmentation:
+        if not inputCurve:
             raise ValueError("Input curve or volume or segmentation is invalid.")
+        self.processCurves([inputCurve], inputVolume, inputSegmentation,
+                           extrusionKernelSize, gaussianStandardDeviation,
+                           seedRadius, shellMargin, shellThickness,
+                           subtractOtherSegments)
+
+    def processCurves(self,
+                      inputCurves,
+                      inputVolume: slicer.vtkMRMLScalarVolumeNode,
+                      inputSegmentation: slicer.vtkMRMLSegmentationNode,
+                      extrusionKernelSize: float = 5.0,
+                      gaussianStandardDeviation: float = 2.0,
+                      seedRadius: float = 1.0,
+                      shellMargin: float = 18.0,
+                      shellThickness: float = 2.0,
+                      subtractOtherSegments: bool = True) -> None:
+        """
+        Segment a vein along each curve of inputCurves, as process() does for
+        one. Each curve is a seed segment; they share a single shell, and
+        compete in a single 'Grow from seeds' run. Adjacent veins, like the
+        vena cava and the iliac veins, are thus separated.
+        """
+
+        if not inputCurves or not all(inputCurves) or not inputVolume or not inputSegmentation:
+            raise ValueError("Input curve or volume or segmentation is invalid.")
+        if len(set(inputCurve.GetID() for inputCurve in inputCurves)) != len(inputCurves):
+            raise ValueError("An input curve is repeated.")
         
         if (extrusionKernelSize <= 0.0
             or gaussianStandardDeviation <= 0.0
@@ -273,93 +307,96 @@ class GuidedVeinSegmentationLogic(ScriptedLoadableModuleLogic):
             for segmentId in allSegments:
                 inputSegmentation.GetDisplayNode().SetSegmentVisibility(segmentId, False)
         
-        # Create a seed segment using the curve polydata.
-        seedSegmentId = inputCurve.GetName()
-        tube = vtk.vtkTubeFilter()
-        tube.SetInputData(inputCurve.GetCurveWorld())
-        tube.SetRadius(seedRadius)
-        tube.SetNumberOfSides(30)
-        tube.CappingOn()
-        tube.Update()
-        seedSegmentId = inputSegmentation.AddSegmentFromClosedSurfaceRepresentation(tube.GetOutput(), seedSegmentId)
-        seWidget.mrmlSegmentEditorNode().SetSelectedSegmentID(seedSegmentId)
-        # Tag the seed segment.
+        """
+        The seed and the shell segments are bands of the distance to the curves,
+        within the bounding box of the shell: a seed is a tube around a curve;
+        the shell is the tubes grown by shellMargin, hollowed outwards by
+        shellThickness. It is outside the grown tubes of all curves.
+        """
+        shellRadius = seedRadius + shellMargin + shellThickness
+        shellExtent = self.curveExtent(inputCurves, inputVolume, shellRadius)
+        curveDistances = self.curveDistanceMap(inputCurves, inputVolume, shellExtent)
+        shellImage = self._orientedImage(inputVolume, shellExtent)
+
+        # Create a seed segment per curve, in the bounding box of its seed; a single curve shares the map of the shell.
         tagSourceCurveId = "SourceCurveId"
-        segment = inputSegmentation.GetSegmentation().GetSegment(seedSegmentId)
-        reference = vtk.reference(inputCurve.GetID())
-        segment.SetTag(tagSourceCurveId, reference)
-        # Increment the visible name for repeat runs; a new segment is created each time.
-        segment.SetName(seedSegmentId)
+        seedSegmentIds = []
+        for inputCurve in inputCurves:
+            seedExtent, seedDistances = shellExtent, curveDistances
+            if len(inputCurves) > 1:
+                seedExtent = self.curveExtent([inputCurve], inputVolume, seedRadius)
+                seedDistances = self.curveDistanceMap([inputCurve], inputVolume, seedExtent)
+            seedSegmentId = inputSegmentation.GetSegmentation().AddEmptySegment(inputCurve.GetName())
+            self._updateSegmentFromArray(inputSegmentation, seedSegmentId, seedDistances <= seedRadius,
+                                         self._orientedImage(inputVolume, seedExtent))
+            # Tag the seed segment.
+            segment = inputSegmentation.GetSegmentation().GetSegment(seedSegmentId)
+            reference = vtk.reference(inputCurve.GetID())
+            segment.SetTag(tagSourceCurveId, reference)
+            # Increment the visible name for repeat runs; a new segment is created each time.
+            segment.SetName(seedSegmentId)
+            seedSegmentIds.append(seedSegmentId)
         
-        # Create a shell segment using the curve polydata : a new tube that will grow and get hollow.
-        shell = vtk.vtkTubeFilter()
-        shell.SetInputData(inputCurve.GetCurveWorld())
-        shell.SetRadius(seedRadius)
-        shell.SetNumberOfSides(30)
-        shell.CappingOn()
-        shell.Update()
-        shellSegmentId = inputSegmentation.AddSegmentFromClosedSurfaceRepresentation(shell.GetOutput(), "Shell")
-        seWidget.mrmlSegmentEditorNode().SetSelectedSegmentID(shellSegmentId)
-        # Grow
-        seWidget.setActiveEffectByName("Margin")
-        effect = seWidget.activeEffect()
-        effect.setParameter("ApplyToAllVisibleSegments", str(0))
-        effect.setParameter("MarginSizeMm", str(shellMargin))
-        effect.self().onApply()
-        seWidget.setActiveEffectByName(None)
-        # Hollow
-        seWidget.setActiveEffectByName("Hollow")
-        effect = seWidget.activeEffect()
-        effect.setParameter("ApplyToAllVisibleSegments", str(0))
-        effect.setParameter("ShellMode", "OUTSIDE_SURFACE")
-        effect.setParameter("ShellThicknessMm", str(shellThickness))
-        effect.self().onApply()
-        seWidget.setActiveEffectByName(None)
+        # Create a shell segment.
+        shellSegmentId = inputSegmentation.GetSegmentation().AddEmptySegment("Shell")
+        shellMask = (curveDistances > seedRadius + shellMargin) & (curveDistances <= shellRadius)
+        self._updateSegmentFromArray(inputSegmentation, shellSegmentId, shellMask, shellImage)
         
-        # Grow the seed within the shell.
-        seWidget.mrmlSegmentEditorNode().SetSelectedSegmentID(seedSegmentId)
+        """
+        The veins cannot grow beyond the shell: crop the source volume to the
+        bounding box of the shell, and work in its geometry until the veins are
+        smoothed. The seed and shell segments are already within it.
+        """
+        shellVolume = self.createBoxVolume(inputVolume, shellExtent)
+        seWidget.setSourceVolumeNode(shellVolume)
+        inputSegmentation.SetReferenceImageGeometryParameterFromVolumeNode(shellVolume)
+
+        # Grow all seeds within the shell at once.
+        seWidget.mrmlSegmentEditorNode().SetSelectedSegmentID(seedSegmentIds[0])
         seWidget.setActiveEffectByName("Grow from seeds")
         effect = seWidget.activeEffect()
         effect.self().onPreview()
         effect.self().onApply()
         seWidget.setActiveEffectByName(None)
         
-        # Smoothing : remove extrusion then Gaussian.
+        # The shell segment is no longer needed.
+        inputSegmentation.GetSegmentation().RemoveSegment(shellSegmentId)
+
+        # Smoothing of all veins, the only visible segments : remove extrusion then Gaussian.
         import SegmentEditorSmoothingEffect
         seWidget.setActiveEffectByName("Smoothing")
         effect = seWidget.activeEffect()
-        effect.setParameter("ApplyToAllVisibleSegments", str(0))
+        effect.setParameter("ApplyToAllVisibleSegments", str(1))
         effect.setParameter("SmoothingMethod", SegmentEditorSmoothingEffect.MORPHOLOGICAL_OPENING)
         effect.setParameter("KernelSizeMm", str(extrusionKernelSize))
         effect.self().onApply()
         effect.setParameter("SmoothingMethod", SegmentEditorSmoothingEffect.GAUSSIAN)
         effect.setParameter("GaussianStandardDeviationMm", str(gaussianStandardDeviation))
         effect.self().onApply()
+        effect.setParameter("ApplyToAllVisibleSegments", str(0))
         seWidget.setActiveEffectByName(None)
         
-        # The shell segment is no longer needed.
-        inputSegmentation.GetSegmentation().RemoveSegment(shellSegmentId)
-        
+        # Remove the cropped volume and get things back.
+        slicer.mrmlScene.RemoveNode(shellVolume)
+        seWidget.setSourceVolumeNode(inputVolume)
+        inputSegmentation.SetReferenceImageGeometryParameterFromVolumeNode(inputVolume)
+
         """
         Remove overlaps with all other segments. Duplicate segments originating
         from the same input curve, due to repeat runs, are excluded.
         It's a good idea to segment nearby bones and arteries before processing
         the veins, which may overlap on the former.
         """
-        if subtractOtherSegments:
-            seWidget.setActiveEffectByName("Logical operators")
-            effect = seWidget.activeEffect()
-            effect.setParameter("BypassMasking", str(1))
-            effect.setParameter("Operation", "SUBTRACT")
-            if allSegments: # Previous ones.
-                for segmentId in allSegments:
-                    segment = inputSegmentation.GetSegmentation().GetSegment(segmentId)
-                    reference = vtk.reference("")
-                    segment.GetTag(tagSourceCurveId, reference)
-                    if reference.get() != inputCurve.GetID(): # Segment does not spring from this unput curve.
-                        effect.setParameter("ModifierSegmentID", segmentId)
-                        effect.self().onApply()
-            seWidget.setActiveEffectByName(None)
+        if subtractOtherSegments and allSegments: # Previous ones.
+            sourceCurveIds = {}
+            for segmentId in allSegments:
+                reference = vtk.reference("")
+                inputSegmentation.GetSegmentation().GetSegment(segmentId).GetTag(tagSourceCurveId, reference)
+                sourceCurveIds[segmentId] = reference.get()
+            for seedSegmentId, inputCurve in zip(seedSegmentIds, inputCurves):
+                # Segments that do not spring from this input curve.
+                otherSegmentIds = [segmentId for segmentId in allSegments if sourceCurveIds[segmentId] != inputCurve.GetID()]
+                self.subtractSegments(inputSegmentation, seedSegmentId, otherSegmentIds)
         
         # Restore segment visibility.
         for segmentIndex in range(visibleSegmentIDs.GetNumberOfValues()):
@@ -368,6 +405,180 @@ class GuidedVeinSegmentationLogic(ScriptedLoadableModuleLogic):
         stopTime = time.time()
         logging.info(f'Processing completed in {stopTime-startTime:.2f} seconds')
 
+    def curveExtent(self, inputCurves, inputVolume, marginMm = 0.0):
+        """
+        IJK extent of the voxels of inputVolume within the bounding box of the
+        curves, padded by marginMm and by one voxel.
+        """
+        allBounds = np.array([inputCurve.GetCurveWorld().GetBounds() for inputCurve in inputCurves])
+        curveBounds = np.ravel(np.stack((allBounds[:, 0::2].min(axis = 0), allBounds[:, 1::2].max(axis = 0)), axis = 1))
+        rasToIJK = vtk.vtkMatrix4x4()
+        inputVolume.GetRASToIJKMatrix(rasToIJK)
+        cornersIJK = np.array([rasToIJK.MultiplyPoint((r, a, s, 1.0))[:3]
+                               for r in (curveBounds[0] - marginMm, curveBounds[1] + marginMm)
+                               for a in (curveBounds[2] - marginMm, curveBounds[3] + marginMm)
+                               for s in (curveBounds[4] - marginMm, curveBounds[5] + marginMm)])
+        volumeExtent = inputVolume.GetImageData().GetExtent()
+        curveExtent = []
+        for axis in range(3):
+            curveExtent.append(max(int(np.floor(cornersIJK[:, axis].min())) - 1, volumeExtent[2 * axis]))
+            curveExtent.append(min(int(np.ceil(cornersIJK[:, axis].max())) + 1, volumeExtent[2 * axis + 1]))
+        if any(curveExtent[2 * axis] > curveExtent[2 * axis + 1] for axis in range(3)):
+            raise ValueError("The curve is outside the volume.")
+        return curveExtent
+
+    def curveDistanceMap(self, inputCurves, inputVolume, extent):
+        """
+        Distance in mm of the voxels of inputVolume within extent to the
+        nearest of the curves, in KJI order. The curves are sampled every half
+        smallest voxel spacing; the voxels that contain a sample are at
+        distance 0, and the distance transform of the box spreads it in a
+        single pass. It is exact to half a voxel, as a labelmap of the curves
+        would be.
+        It is cached as float32, and reused until the curves or the geometry of
+        the volume change: repeat runs do not compute it again. It must not be
+        modified. The cache holds distanceMapCacheBytes at most, a single map
+        larger than that is not kept.
+        """
+        key = self._distanceMapKey(inputCurves, inputVolume, extent)
+        distanceMap = self._distanceMapCache.pop(key, None)
+        if distanceMap is None:
+            distanceMap = self._computeCurveDistanceMap(inputCurves, inputVolume, extent)
+            distanceMap.flags.writeable = False
+        # Dicts keep insertion order: a map used again moves to the end, and
+        # eviction starts from the front.
+        self._distanceMapCache[key] = distanceMap
+        cachedBytes = sum(cachedMap.nbytes for cachedMap in self._distanceMapCache.values())
+        while cachedBytes > self.distanceMapCacheBytes:
+            cachedBytes -= self._distanceMapCache.pop(next(iter(self._distanceMapCache))).nbytes
+        return distanceMap
+
+    def _distanceMapKey(self, inputCurves, inputVolume, extent):
+        # The intensities of the volume do not matter, only its geometry.
+        ijkToRAS = vtk.vtkMatrix4x4()
+        inputVolume.GetIJKToRASMatrix(ijkToRAS)
+        return (tuple((inputCurve.GetID(),
+                       numpy_support.vtk_to_numpy(inputCurve.GetCurveWorld().GetPoints().GetData()).tobytes())
+                      for inputCurve in inputCurves),
+                tuple(ijkToRAS.GetElement(row, column) for row in range(3) for column in range(4)),
+                tuple(extent))
+
+    def clearDistanceMapCache(self):
+        self._distanceMapCache.clear()
+
+    def _computeCurveDistanceMap(self, inputCurves, inputVolume, extent):
+        spacing = inputVolume.GetSpacing()
+        step = min(spacing) / 2.0
+        samplePoints = np.concatenate([self._curveSamples(inputCurve, step) for inputCurve in inputCurves])
+
+        rasToIJK = vtk.vtkMatrix4x4()
+        inputVolume.GetRASToIJKMatrix(rasToIJK)
+        rasToIJKArray = slicer.util.arrayFromVTKMatrix(rasToIJK)
+        sampleIndices = np.rint(samplePoints @ rasToIJKArray[:3, :3].T + rasToIJKArray[:3, 3]).astype(np.intp)
+        sampleIndices -= (extent[0], extent[2], extent[4])
+        boxShape = (extent[5] - extent[4] + 1, extent[3] - extent[2] + 1, extent[1] - extent[0] + 1)
+        isInBox = np.all((sampleIndices >= 0) & (sampleIndices < boxShape[::-1]), axis = 1)
+        isFar = np.ones(boxShape, dtype = np.bool_)
+        isFar[tuple(sampleIndices[isInBox, ::-1].T)] = False
+        if isFar.all():
+            raise ValueError("The curve is outside the volume.")
+        return ndimage.distance_transform_edt(isFar, sampling = spacing[::-1]).astype(np.float32)
+
+    def subtractSegments(self, inputSegmentation, segmentId, modifierSegmentIds):
+        """
+        Remove the voxels of the modifier segments from a segment, as the
+        'Logical operators' SUBTRACT operation, in a single pass. The modifier
+        segments whose bounds do not intersect those of the segment are not
+        read; the others are merged in the geometry of the segment first.
+        """
+        segmentImage = slicer.vtkOrientedImageData()
+        inputSegmentation.GetBinaryLabelmapRepresentation(segmentId, segmentImage)
+        if segmentImage.IsEmpty():
+            return
+        segmentBounds = [0.0] * 6
+        segmentImage.GetBounds(segmentBounds)
+        # Voxels that touch are not missed.
+        tolerance = max(segmentImage.GetSpacing())
+        modifierMask = None
+        for modifierSegmentId in modifierSegmentIds:
+            modifierBounds = [0.0] * 6
+            inputSegmentation.GetSegmentation().GetSegment(modifierSegmentId).GetBounds(modifierBounds)
+            if any(modifierBounds[2 * axis] > segmentBounds[2 * axis + 1] + tolerance
+                   or segmentBounds[2 * axis] > modifierBounds[2 * axis + 1] + tolerance for axis in range(3)):
+                continue
+            modifierSegmentMask = self._segmentMask(inputSegmentation, modifierSegmentId, segmentImage)
+            if modifierSegmentMask is None:
+                continue
+            if modifierMask is None:
+                modifierMask = modifierSegmentMask
+            else:
+                modifierMask |= modifierSegmentMask
+        if modifierMask is None:
+            return
+        segmentMask = self._imageArray(segmentImage) > 0
+        segmentMask &= ~modifierMask
+        self._updateSegmentFromArray(inputSegmentation, segmentId, segmentMask, segmentImage)
+
+    def _segmentMask(self, inputSegmentation, segmentId, referenceImage):
+        # Mask of a segment, cropped or padded to the array of referenceImage; None if empty.
+        segmentImage = slicer.vtkOrientedImageData()
+        inputSegmentation.GetBinaryLabelmapRepresentation(segmentId, segmentImage)
+        if segmentImage.IsEmpty():
+            return None
+        resampledImage = slicer.vtkOrientedImageData()
+        # padImage is off: a larger segment must not grow the output beyond the reference.
+        if not slicer.vtkOrientedImageDataResample.ResampleOrientedImageToReferenceOrientedImage(segmentImage, referenceImage, resampledImage, False, False):
+            return None
+        return self._imageArray(resampledImage) > 0
+
+    def _curveSamples(self, inputCurve, step):
+        # Points of the curve, every step mm at most; every segment of the curve is sampled at once.
+        curvePoints = numpy_support.vtk_to_numpy(inputCurve.GetCurveWorld().GetPoints().GetData()).astype(np.float64)
+        if len(curvePoints) < 2:
+            raise ValueError("The curve has less than 2 points.")
+        segmentVectors = np.diff(curvePoints, axis = 0)
+        numberOfSamples = np.maximum(np.ceil(np.linalg.norm(segmentVectors, axis = 1) / step).astype(np.intp), 1)
+        segmentIndices = np.repeat(np.arange(len(segmentVectors)), numberOfSamples)
+        sampleOffsets = np.arange(numberOfSamples.sum()) - np.repeat(np.cumsum(numberOfSamples) - numberOfSamples, numberOfSamples)
+        samplePoints = curvePoints[segmentIndices] + segmentVectors[segmentIndices] * (sampleOffsets / numberOfSamples[segmentIndices])[:, np.newaxis]
+        return np.concatenate((samplePoints, curvePoints[-1:]))
+
+    def createBoxVolume(self, inputVolume, extent):
+        # A scalar volume node of the voxels of inputVolume within extent, in its geometry.
+        boxVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", inputVolume.GetName() + "_Box")
+        ijkToRAS = vtk.vtkMatrix4x4()
+        inputVolume.GetIJKToRASMatrix(ijkToRAS)
+        boxOrigin = ijkToRAS.MultiplyPoint((extent[0], extent[2], extent[4], 1.0))
+        boxVolume.SetIJKToRASMatrix(ijkToRAS)
+        boxVolume.SetOrigin(boxOrigin[:3])
+        boxSlices = tuple(slice(extent[2 * axis], extent[2 * axis + 1] + 1) for axis in (2, 1, 0))
+        slicer.util.updateVolumeFromArray(boxVolume, slicer.util.arrayFromVolume(inputVolume)[boxSlices])
+        boxVolume.SetAndObserveTransformNodeID(inputVolume.GetTransformNodeID())
+        boxVolume.CreateDefaultDisplayNodes()
+        return boxVolume
+
+    def _orientedImage(self, inputVolume, extent):
+        # A zero-filled uint8 oriented image with the IJK to RAS matrix of inputVolume, over extent.
+        ijkToRAS = vtk.vtkMatrix4x4()
+        inputVolume.GetIJKToRASMatrix(ijkToRAS)
+        orientedImage = slicer.vtkOrientedImageData()
+        orientedImage.SetImageToWorldMatrix(ijkToRAS)
+        orientedImage.SetExtent(extent)
+        orientedImage.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+        orientedImage.GetPointData().GetScalars().Fill(0)
+        return orientedImage
+
+    def _imageArray(self, image):
+        # A view of the scalars of image, indexed [k, j, i]; writing to it writes to the image.
+        return numpy_support.vtk_to_numpy(image.GetPointData().GetScalars()).reshape(image.GetDimensions()[::-1])
+
+    def _updateSegmentFromArray(self, inputSegmentation, segmentId, mask, referenceImage):
+        # referenceImage is reused as the buffer of mask, a KJI array of the same extent.
+        np.copyto(self._imageArray(referenceImage), mask)
+        slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(referenceImage, inputSegmentation, segmentId,
+                                                                            slicer.vtkSlicerSegmentationsModuleLogic.MODE_REPLACE,
+                                                                            referenceImage.GetExtent())
+
 
 #
 # GuidedVeinSegmentationTest
@@ -390,8 +601,86 @@ class GuidedVeinSegmentationTest(ScriptedLoadableModuleTest):
         """
         self.setUp()
         self.test_GuidedVeinSegmentation1()
+        self.setUp()
+        self.test_SubtractLargerSegment()
+        self.setUp()
+        self.test_CurveDistanceMap()
+        self.setUp()
+        self.test_DistanceMapCache()
 
     def test_GuidedVeinSegmentation1(self):
         self.delayDisplay("Starting the test")
 
         self.delayDisplay('Test passed')
+
+    def test_SubtractLargerSegment(self):
+        # The modifier segment extends beyond the vein on all sides.
+        self.delayDisplay("Starting the test")
+        volumeNode = slicer.util.addVolumeFromArray(np.zeros((40, 40, 40), dtype = np.int16))
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+        segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(volumeNode)
+        veinId = segmentationNode.GetSegmentation().AddEmptySegment("Vein")
+        modifierId = segmentationNode.GetSegmentation().AddEmptySegment("Modifier")
+        veinArray = np.zeros((40, 40, 40), dtype = np.uint8)
+        veinArray[10:20, 10:20, 10:20] = 1
+        modifierArray = np.zeros((40, 40, 40), dtype = np.uint8)
+        modifierArray[5:15, 2:38, 2:38] = 1
+        slicer.util.updateSegmentBinaryLabelmapFromArray(veinArray, segmentationNode, veinId, volumeNode)
+        slicer.util.updateSegmentBinaryLabelmapFromArray(modifierArray, segmentationNode, modifierId, volumeNode)
+
+        logic = GuidedVeinSegmentationLogic()
+        logic.subtractSegments(segmentationNode, veinId, [modifierId])
+
+        expectedArray = np.zeros((40, 40, 40), dtype = np.uint8)
+        expectedArray[15:20, 10:20, 10:20] = 1
+        resultArray = slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, veinId, volumeNode)
+        self.assertTrue(np.array_equal(resultArray > 0, expectedArray > 0))
+        self.delayDisplay('Test passed')
+
+    def test_CurveDistanceMap(self):
+        # A straight curve: the distance of a voxel is that to a segment.
+        self.delayDisplay("Starting the test")
+        volumeNode = slicer.util.addVolumeFromArray(np.zeros((40, 40, 40), dtype = np.int16))
+        volumeNode.SetSpacing(0.5, 0.5, 1.0)
+        volumeNode.SetOrigin(-10.0, -10.0, -20.0)
+        curveNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsCurveNode")
+        curveNode.SetCurveTypeToLinear()
+        slicer.util.updateMarkupsControlPointsFromArray(curveNode, np.array([[0.0, 0.0, -10.0], [0.0, 0.0, 10.0]]))
+
+        logic = GuidedVeinSegmentationLogic()
+        extent = logic.curveExtent([curveNode], volumeNode, 5.0)
+        distanceMap = logic.curveDistanceMap([curveNode], volumeNode, extent)
+        self.assertEqual(distanceMap.shape, (extent[5] - extent[4] + 1, extent[3] - extent[2] + 1, extent[1] - extent[0] + 1))
+        k, j, i = np.mgrid[extent[4]:extent[5] + 1, extent[2]:extent[3] + 1, extent[0]:extent[1] + 1]
+        r, a, s = i * 0.5 - 10.0, j * 0.5 - 10.0, k * 1.0 - 20.0
+        exactMap = np.sqrt(r ** 2 + a ** 2 + np.maximum(np.abs(s) - 10.0, 0.0) ** 2)
+        # The voxels of the curve are at distance 0, the error is half a voxel at most.
+        self.assertLessEqual(np.abs(distanceMap - exactMap).max(), 0.5 * np.linalg.norm((0.5, 0.5, 1.0)) + 1e-6)
+        self.delayDisplay('Test passed')
+
+    def test_DistanceMapCache(self):
+        # The map is cached, read-only and float32, until the curve changes, within distanceMapCacheBytes.
+        self.delayDisplay("Starting the test")
+        volumeNode = slicer.util.addVolumeFromArray(np.zeros((40, 40, 40), dtype = np.int16))
+        curveNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsCurveNode")
+        curveNode.SetCurveTypeToLinear()
+        slicer.util.updateMarkupsControlPointsFromArray(curveNode, np.array([[20.0, 20.0, 10.0], [20.0, 20.0, 30.0]]))
+
+        logic = GuidedVeinSegmentationLogic()
+        extent = logic.curveExtent([curveNode], volumeNode, 5.0)
+        distanceMap = logic.curveDistanceMap([curveNode], volumeNode, extent)
+        self.assertEqual(distanceMap.dtype, np.float32)
+        self.assertFalse(distanceMap.flags.writeable)
+        self.assertIs(logic.curveDistanceMap([curveNode], volumeNode, extent), distanceMap)
+        curveNode.SetNthControlPointPosition(1, 20.0, 20.0, 25.0)
+        movedDistanceMap = logic.curveDistanceMap([curveNode], volumeNode, extent)
+        self.assertIsNot(movedDistanceMap, distanceMap)
+        # Both maps fit, a smaller budget keeps the last one only, and none if it is too large.
+        self.assertEqual(len(logic._distanceMapCache), 2)
+        logic.distanceMapCacheBytes = movedDistanceMap.nbytes
+        self.assertIs(logic.curveDistanceMap([curveNode], volumeNode, extent), movedDistanceMap)
+        self.assertEqual(len(logic._distanceMapCache), 1)
+        logic.distanceMapCacheBytes = movedDistanceMap.nbytes - 1
+        logic.curveDistanceMap([curveNode], volumeNode, extent)
+        self.assertEqual(len(logic._distanceMapCache), 0)
+        self.delayDisplay('Test passed')